@@ -0,0 +1,99 @@
+"""
+Benchmark: recall vs latency of the index_factory backends.
+
+Builds every backend on a synthetic clustered corpus, uses the flat index
+as ground truth and reports build time, recall@k and per-query latency for
+a sweep of nprobe / efSearch values. No API key is needed.
+
+Usage (from backend/):
+    python benchmarks/bench_ann_backends.py --n 200000 --dim 384 --queries 500
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import index_factory  # noqa: E402
+
+
+def make_corpus(n: int, dim: int, n_queries: int, clusters: int = 256, seed: int = 0):
+    """Gaussian clusters on the unit sphere, loosely resembling sentence embeddings."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype("float32")
+    labels = rng.integers(0, clusters, size=n + n_queries)
+    points = centers[labels] + 0.35 * rng.normal(size=(n + n_queries, dim)).astype("float32")
+    points /= np.linalg.norm(points, axis=1, keepdims=True)
+    return points[:n], points[n:]
+
+
+def timed_search(index, queries, k, params):
+    start = time.perf_counter()
+    _, I = index.search(queries, k, params=params)
+    return I, (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(np.intersect1d(f[f >= 0], t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=100000, help="corpus size")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=None, help="override FAISS_IVF_NLIST")
+    parser.add_argument("--pq-m", type=int, default=None, help="override FAISS_PQ_M")
+    args = parser.parse_args()
+
+    if args.nlist:
+        index_factory.IVF_NLIST = args.nlist
+    if args.pq_m:
+        index_factory.PQ_M = args.pq_m
+
+    corpus, queries = make_corpus(args.n, args.dim, args.queries)
+    ids = np.arange(args.n, dtype="int64")
+
+    sweeps = {
+        "flat": [None],
+        "ivf_flat": [1, 4, 16, 64],
+        "ivf_pq": [1, 4, 16, 64],
+        "hnsw": [16, 32, 64, 128, 256],
+    }
+
+    truth = None
+    print(f"corpus: {args.n} x {args.dim}  queries: {args.queries}  k: {args.k}  "
+          f"nlist: {index_factory.IVF_NLIST}  pq_m: {index_factory.PQ_M}")
+    print(f"{'backend':<10}{'param':>14}{'build (s)':>12}{'recall@k':>10}{'ms/query':>10}")
+
+    for kind, values in sweeps.items():
+        start = time.perf_counter()
+        index = index_factory.build_index(corpus, ids, kind)
+        build_time = time.perf_counter() - start
+        built_kind = index_factory.index_kind(index)
+        if built_kind != kind:
+            print(f"{kind:<10}  skipped: needs {index_factory.min_training_points(kind)} training points")
+            continue
+
+        for value in values:
+            if kind == "hnsw":
+                params, label = index_factory.search_params(index, ef_search=value), f"efSearch={value}"
+            elif kind.startswith("ivf"):
+                params, label = index_factory.search_params(index, nprobe=value), f"nprobe={value}"
+            else:
+                params, label = None, "-"
+
+            found, latency = timed_search(index, queries, args.k, params)
+            if truth is None:
+                truth = found  # the flat backend runs first and is exact
+            print(f"{kind:<10}{label:>14}{build_time:>12.2f}{recall_at_k(found, truth):>10.3f}{latency:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Benchmark: StreamingChunker throughput and memory, with correctness checks.
+
+Chunks a synthetic multi-page document (sentences with closing quotes and
+brackets, paragraph breaks, one over-long sentence, a page-long base64 blob
+with no whitespace and a page of CJK text) and checks that:
+- every chunk's text equals document[start:end] and its page is the page
+  containing start
+- every non-space character of the document is covered by some chunk
+- no chunk exceeds the token budget
+Then streams the document repeatedly through iter_chunks and reports the
+throughput and the peak traced memory.
+
+Usage (from backend/):
+    python benchmarks/bench_chunker.py --pages 200 --repeat 20
+"""
+
+import argparse
+import base64
+import bisect
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = "the revenue costs growth system invoice ledger gateway quarter report sync error".split()
+CJK_WORDS = "系统 错误 日志 服务器 发票 报告 季度 网关 增长 成本".split()
+ENDINGS = [".", "!", "?", '."', ".)", '?"', ".]"]
+
+
+def make_pages(count: int, seed: int = 1) -> list[str]:
+    rng = random.Random(seed)
+
+    def sentence():
+        words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 40))).capitalize()
+        ending = rng.choice(ENDINGS)
+        opening = {'"': '"', ")": "(", "]": "["}.get(ending[-1], "")
+        return opening + words + ending
+
+    pages = []
+    for _ in range(count):
+        paragraphs = [" ".join(sentence() for _ in range(rng.randint(1, 8))) for _ in range(rng.randint(1, 4))]
+        pages.append("\n\n".join(paragraphs))
+    pages[count // 2] = " ".join(["word"] * 900)  # one sentence longer than a chunk
+    pages[count // 3] = base64.b64encode(rng.randbytes(45000)).decode()  # one 60k-character word
+    pages[count // 4] = "".join(  # no whitespace at all; sentences end in full-width punctuation
+        "".join(rng.choice(CJK_WORDS) for _ in range(rng.randint(3, 30))) + rng.choice("。！？") for _ in range(60)
+    ) + "".join(rng.choice(CJK_WORDS) for _ in range(1500))  # and one unpunctuated run longer than a chunk
+    return pages
+
+
+def check(pages: list[str], chunk_tokens: int, overlap_tokens: int):
+    import chunker
+
+    document = "\n".join(pages)
+    page_starts = [0]
+    for page in pages[:-1]:
+        page_starts.append(page_starts[-1] + len(page) + 1)
+
+    chunks = list(chunker.iter_chunks(pages, chunk_tokens, overlap_tokens))
+    covered = bytearray(len(document))
+    for chunk in chunks:
+        assert document[chunk.start:chunk.end] == chunk.text, f"span mismatch at {chunk.start}"
+        assert bisect.bisect_right(page_starts, chunk.start) == chunk.page, f"wrong page at {chunk.start}"
+        assert chunker.count_tokens(chunk.text) <= chunk_tokens, f"oversized chunk at {chunk.start}"
+        covered[chunk.start:chunk.end] = b"\x01" * (chunk.end - chunk.start)
+    uncovered = [i for i, char in enumerate(document) if not covered[i] and not char.isspace()]
+    assert not uncovered, f"{len(uncovered)} characters in no chunk, first at {uncovered[0]}"
+
+    # Closing quotes and brackets stay with their sentence
+    quoted = 'He said "stop." Then (he left.) Done.'
+    sentences = [chunk.text for chunk in chunker.iter_chunks([quoted], 6, 0)]
+    assert sentences == ['He said "stop."', "Then (he left.) Done."], sentences
+    return len(chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=20, help="times the document is streamed")
+    parser.add_argument("--chunk-tokens", type=int, default=200)
+    parser.add_argument("--overlap-tokens", type=int, default=25)
+    args = parser.parse_args()
+
+    import chunker
+
+    pages = make_pages(args.pages)
+    checked = check(pages, args.chunk_tokens, args.overlap_tokens)
+
+    def stream():
+        for _ in range(args.repeat):
+            yield from pages
+
+    megabytes = (sum(len(page) + 1 for page in pages) * args.repeat) / 1e6
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = sum(1 for _ in chunker.iter_chunks(stream(), args.chunk_tokens, args.overlap_tokens))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"checked: {checked} chunks of {args.pages} pages (spans, pages, coverage, token budget)")
+    print(f"streamed: {megabytes:.1f} MB -> {count} chunks in {elapsed:.2f} s ({megabytes / elapsed:.2f} MB/s)")
+    print(f"peak traced memory: {peak / 1024:.0f} KB")
+
+
+if __name__ == "__main__":
+    main()
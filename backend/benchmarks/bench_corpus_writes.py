@@ -0,0 +1,87 @@
+"""
+Benchmark: cost of corpus writes (adding and removing chunks) on a large corpus.
+
+Fills rag_engine with --chunks random vectors (no API calls: chunks go
+straight to index_chunks), then times adding one small file, removing one
+file of --remove chunks, and a query against each resulting snapshot, and
+reports the peak resident memory of the process. Writes should cost time
+proportional to the chunks they touch, not to the corpus.
+
+Usage (from backend/):
+    python benchmarks/bench_corpus_writes.py --chunks 60000 --dim 1536
+    python benchmarks/bench_corpus_writes.py --chunks 60000 --store /tmp/bench_store
+"""
+
+import argparse
+import os
+import resource
+import shutil
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def records(filename: str, count: int, start: int = 0) -> list[dict]:
+    return [{"filename": filename, "chunk": f"{filename} chunk {start + i} about revenue and costs"}
+            for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=60000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--file-chunks", type=int, default=100, help="chunks per file in the initial corpus")
+    parser.add_argument("--remove", type=int, default=100, help="chunks of the removed file")
+    parser.add_argument("--store", default="", help="vector store directory (default: in memory only)")
+    args = parser.parse_args()
+
+    if args.store:
+        shutil.rmtree(args.store, ignore_errors=True)
+    os.environ["VECTORSTORE_DIR"] = args.store
+    os.environ["EMBEDDING_CACHE_PATH"] = ""
+    os.environ.setdefault("OPENAI_API_KEY", "sk-unused")  # no API calls are made
+    import rag_engine
+
+    rng = np.random.default_rng(0)
+
+    def vectors(count):
+        return rng.standard_normal((count, args.dim), dtype="float32")
+
+    start = time.perf_counter()
+    corpus = [record for first in range(0, args.chunks, args.file_chunks)
+              for record in records(f"f{first // args.file_chunks}.txt", min(args.file_chunks, args.chunks - first))]
+    rag_engine.index_chunks(corpus, vectors(len(corpus)))
+    rag_engine.index_chunks(records("removed.txt", args.remove), vectors(args.remove))
+    print(f"built: {len(corpus) + args.remove} chunks in {time.perf_counter() - start:.1f} s")
+
+    query = vectors(1)
+
+    def timed_query():
+        start = time.perf_counter()
+        rag_engine.search_index(query, 3, question="revenue and costs")
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    rag_engine.index_chunks(records("new.txt", 1), vectors(1))
+    add_time = time.perf_counter() - start
+    add_query = timed_query()
+
+    start = time.perf_counter()
+    removed = rag_engine.remove_documents(["removed.txt"])
+    remove_time = time.perf_counter() - start
+    remove_query = timed_query()
+    assert removed == ["removed.txt"]
+    assert not rag_engine.current_snapshot().segments.has_file("removed.txt")
+
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{'write':<28}{'write (s)':>12}{'next query (s)':>16}")
+    print(f"{'add 1 chunk':<28}{add_time:>12.4f}{add_query:>16.4f}")
+    print(f"{f'remove {args.remove} chunks':<28}{remove_time:>12.4f}{remove_query:>16.4f}")
+    print(f"peak RSS: {peak_mb:.0f} MB (vectors: {(args.chunks + args.remove) * args.dim * 4 / 2 ** 20:.0f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Benchmark: per-chunk vs batched embedding requests during ingestion.
+
+Starts a local stub of the OpenAI embeddings endpoint, points rag_engine's
+client at it and compares the number of HTTP calls and the wall time of
+embedding one chunk per request against rag_engine.embed_texts.
+
+Usage (from backend/):
+    python benchmarks/bench_embedding_batching.py --chunks 2000 --latency-ms 30
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StubEmbeddingServer:
+    """Minimal /v1/embeddings server returning deterministic vectors."""
+
+    def __init__(self, dim: int, latency_ms: float, fail_every: int = 0):
+        self.dim = dim
+        self.latency = latency_ms / 1000
+        self.fail_every = fail_every
+        self.calls = 0
+        self.inputs = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+                with stub._lock:
+                    stub.calls += 1
+                    call_no = stub.calls
+                    stub.inputs += len(inputs)
+                time.sleep(stub.latency)
+
+                if stub.fail_every and call_no % stub.fail_every == 0:
+                    self.send_response(400)  # not retried by the OpenAI client itself
+                    self.send_header("Content-Type", "application/json")
+                    self.end_headers()
+                    self.wfile.write(b'{"error": {"message": "injected failure"}}')
+                    return
+
+                data = []
+                for i, text in enumerate(inputs):
+                    rng = np.random.default_rng(abs(hash(text)) % (2 ** 32))
+                    data.append({"object": "embedding", "index": i,
+                                 "embedding": rng.random(stub.dim).round(6).tolist()})
+                payload = json.dumps({
+                    "object": "list", "data": data, "model": body["model"],
+                    "usage": {"prompt_tokens": 0, "total_tokens": 0},
+                }).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+
+    def reset(self):
+        self.calls = 0
+        self.inputs = 0
+
+
+def make_chunks(n: int) -> list[str]:
+    words = ["retrieval", "vector", "index", "answer", "context", "report", "metric", "chunk"]
+    rng = np.random.default_rng(0)
+    return [" ".join(rng.choice(words, size=120)) + f" #{i}" for i in range(n)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=1000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="simulated per-request latency")
+    parser.add_argument("--batch-size", type=int, default=None, help="override EMBED_BATCH_SIZE")
+    parser.add_argument("--fail-every", type=int, default=0,
+                        help="fail every Nth batched request to exercise per-batch retries")
+    args = parser.parse_args()
+
+    with StubEmbeddingServer(args.dim, args.latency_ms) as server:
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        os.environ["OPENAI_API_KEY"] = "stub"
+        import rag_engine
+        rag_engine.EMBED_MAX_RETRIES = 3
+        rag_engine.embedding_cache = None  # measure batching alone, not cache hits
+        if args.batch_size:
+            rag_engine.EMBED_BATCH_SIZE = args.batch_size
+        rag_engine.EMBED_RETRY_DELAY = 0  # skip retry back-off; the stub's simulated latency still applies
+
+        chunks = make_chunks(args.chunks)
+
+        # Baseline: one request per chunk (previous add_documents behaviour)
+        start = time.perf_counter()
+        serial = [
+            rag_engine.embed_batch([chunk])[0]
+            for chunk in chunks
+        ]
+        serial_time = time.perf_counter() - start
+        serial_calls = server.calls
+
+        server.reset()
+        server.fail_every = args.fail_every
+        start = time.perf_counter()
+        batched = rag_engine.embed_texts(chunks)
+        batched_time = time.perf_counter() - start
+        batched_calls = server.calls
+
+        assert batched.shape == (len(chunks), args.dim)
+        assert np.allclose(np.array(serial, dtype="float32"), batched), "batched rows out of order"
+
+    print(f"chunks: {args.chunks}  batch size: {rag_engine.EMBED_BATCH_SIZE}  "
+          f"batch tokens: {rag_engine.EMBED_BATCH_TOKENS}")
+    print(f"{'mode':<10}{'calls':>8}{'wall (s)':>12}")
+    print(f"{'serial':<10}{serial_calls:>8}{serial_time:>12.3f}")
+    print(f"{'batched':<10}{batched_calls:>8}{batched_time:>12.3f}   (includes retried batches)")
+    print(f"speedup: {serial_time / batched_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,247 @@
 # In-memory cache for  RAG + metrics (answers/context/metrics)
-answers_cache = {}
\ No newline at end of file
+# Bounded by entry count and bytes, with per-entry TTL and LRU or LFU eviction.
+# Keys are (question, corpus_version); entries are tagged with their source files.
+
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_MAX_BYTES = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))  # seconds, 0 = no expiry
+ANSWER_CACHE_POLICY = os.getenv("ANSWER_CACHE_POLICY", "lru")    # "lru" or "lfu"
+
+
+def cache_key(question: str, corpus_version: int, files: list = None):
+    """Answers are only valid for the corpus (and the file scope) they were generated from."""
+    if files is None:
+        return (question, corpus_version)
+    return (question, corpus_version, tuple(sorted(set(files))))
+
+
+def deep_sizeof(obj, seen=None) -> int:
+    """Approximate memory footprint of a cache value (dicts, lists, strings, numbers)."""
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+class AnswerCache:
+    """
+    Dict-like cache: supports cache[key] = value, cache[key], cache.get(key),
+    `key in cache`, del cache[key] and len(cache).
+
+    Values that are mutated in place after insertion should be written back
+    with update_entry() so their size is re-measured.
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, max_bytes: int = ANSWER_CACHE_MAX_BYTES,
+                 ttl: float = ANSWER_CACHE_TTL, policy: str = ANSWER_CACHE_POLICY):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown cache policy {policy!r}, expected 'lru' or 'lfu'")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.policy = policy
+
+        self._entries = OrderedDict()  # key -> [value, expires_at, size, hits, tags]; order = recency
+        self._tagged = {}  # tag (source filename) -> set of keys
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    # -----------------------------
+    # Dict interface
+    # -----------------------------
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._drop(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._live_entry(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            entry[3] += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl: float = None, tags=()):
+        """Insert or replace an entry. tags (e.g. source filenames) allow selective invalidation."""
+        ttl = self.ttl if ttl is None else ttl
+        size = deep_sizeof(value)
+        with self._lock:
+            hits = 0
+            if key in self._entries:
+                hits = self._entries[key][3]
+                self._drop(key)
+            if size > self.max_bytes:
+                return  # would evict everything else and still not fit
+            tags = frozenset(tags)
+            self._entries[key] = [value, time.monotonic() + ttl if ttl else None, size, hits, tags]
+            self._bytes += size
+            for tag in tags:
+                self._tagged.setdefault(tag, set()).add(key)
+            self._evict(keep=key)
+
+    def update_entry(self, key, **fields):
+        """Update fields of a cached dict value in place and re-measure it. No-op if the key is gone."""
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                return False
+            entry[0].update(fields)
+            new_size = deep_sizeof(entry[0])
+            self._bytes += new_size - entry[2]
+            entry[2] = new_size
+            self._evict(keep=key)
+            return True
+
+    def alias(self, new_key, existing_key) -> bool:
+        """Make new_key share existing_key's value (same dict, tags and expiry)."""
+        with self._lock:
+            entry = self._live_entry(existing_key)
+            if entry is None:
+                return False
+            self._drop(new_key)
+            self._entries[new_key] = [entry[0], entry[1], entry[2], 0, entry[4]]
+            self._bytes += entry[2]
+            for tag in entry[4]:
+                self._tagged[tag].add(new_key)
+            self._evict(keep=new_key)
+            return True
+
+    def invalidate(self, tags) -> int:
+        """Drop every entry tagged with any of the given tags. Returns the number dropped."""
+        with self._lock:
+            keys = set().union(*(self._tagged.get(tag, ()) for tag in tags))
+            for key in keys:
+                self._drop(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def migrate_version(self, old_version: int, new_version: int):
+        """
+        Re-key (question, old_version[, files]) entries to new_version, keeping
+        recency order and file scope. Used after a removal so answers whose
+        sources were untouched stay hot.
+        """
+        with self._lock:
+            migrated = OrderedDict()
+            for key, entry in self._entries.items():
+                if isinstance(key, tuple) and key[1] == old_version:
+                    new_key = (key[0], new_version, *key[2:])
+                    if new_key in self._entries or new_key in migrated:
+                        # Already answered against the new corpus; the old answer is redundant
+                        self._bytes -= entry[2]
+                        for tag in entry[4]:
+                            self._tagged[tag].discard(key)
+                        continue
+                    for tag in entry[4]:
+                        self._tagged[tag].discard(key)
+                        self._tagged[tag].add(new_key)
+                    key = new_key
+                migrated[key] = entry
+            self._entries = migrated
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tagged.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "policy": self.policy,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+    # -----------------------------
+    # Internals (call with the lock held)
+    # -----------------------------
+    def _live_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+            for tag in entry[4]:
+                keys = self._tagged[tag]
+                keys.discard(key)
+                if not keys:
+                    del self._tagged[tag]
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        expired = [k for k, e in self._entries.items() if e[1] is not None and e[1] <= now]
+        for key in expired:
+            self._drop(key)
+        self.expirations += len(expired)
+
+    def _evict(self, keep=None):
+        if len(self._entries) <= self.max_entries and self._bytes <= self.max_bytes:
+            return
+        self._purge_expired()
+        while (len(self._entries) > self.max_entries or self._bytes > self.max_bytes) and len(self._entries) > 1:
+            candidates = (k for k in self._entries if k != keep)
+            if self.policy == "lru":
+                victim = next(candidates)  # least recently used is first
+            else:
+                victim = min(candidates, key=lambda k: self._entries[k][3])  # ties -> least recent
+            self._drop(victim)
+            self.evictions += 1
+
+
+_MISSING = object()
+
+answers_cache = AnswerCache()
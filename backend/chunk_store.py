@@ -0,0 +1,155 @@
+"""
+Columnar chunk metadata for rag_engine snapshots.
+
+Instead of one {"filename", "chunk"} dict per chunk, a ChunkStore keeps:
+- filenames   interned file names (file id -> name)
+- file_ids    int32 file id per row
+- text        all chunk texts as one contiguous UTF-8 buffer
+- offsets     int64 row boundaries into text (row i is text[offsets[i]:offsets[i + 1]])
+- spans       int64 (page, start, end) per row: the chunk's source page and character
+              offsets in its document (-1 for chunks stored before offsets were recorded)
+- ranges      per-file (start_row, end_row) ranges, kept up to date by append(), so a
+              file-scoped lookup costs O(ranges of those files), not O(rows)
+
+Rows are aligned with a segment's chunk_ids / embeddings (see segments), so
+filtering is a single boolean mask applied to every column. A ChunkStore
+is never mutated: append(), take() and concat() return new stores.
+"""
+
+import numpy as np
+
+
+class ChunkStore:
+    def __init__(self, filenames: tuple = (), file_ids: np.ndarray = None, text: bytes = b"",
+                 offsets: np.ndarray = None, spans: np.ndarray = None, ranges: dict = None):
+        self.filenames = tuple(filenames)
+        self.file_index = {name: i for i, name in enumerate(self.filenames)}
+        self.file_ids = file_ids if file_ids is not None else np.empty(0, dtype="int32")
+        self.text = text
+        self.offsets = offsets if offsets is not None else np.zeros(1, dtype="int64")
+        self.spans = spans if spans is not None else np.empty((0, 3), dtype="int64")
+        # filename -> ((start_row, end_row), ...); one range unless the file was uploaded twice
+        self.ranges = ranges if ranges is not None else self._add_ranges({}, self.file_ids, 0)
+
+    @classmethod
+    def from_records(cls, records: list[dict]) -> "ChunkStore":
+        return cls().append(records)
+
+    def __len__(self):
+        return len(self.file_ids)
+
+    # -----------------------------
+    # Row access
+    # -----------------------------
+    def chunk(self, row: int) -> str:
+        return self.text[self.offsets[row]:self.offsets[row + 1]].decode("utf-8")
+
+    def filename(self, row: int) -> str:
+        return self.filenames[self.file_ids[row]]
+
+    def record(self, row: int) -> dict:
+        record = {"filename": self.filename(row), "chunk": self.chunk(row)}
+        page, start, end = self.spans[row].tolist()
+        if start >= 0:
+            record.update(page=page, start=start, end=end)
+        return record
+
+    def records(self, rows) -> list[dict]:
+        return [self.record(row) for row in rows]
+
+    # -----------------------------
+    # Per-file views
+    # -----------------------------
+    def files(self) -> list[str]:
+        """Names of the files that still have chunks, in first-seen order."""
+        present = np.zeros(len(self.filenames), dtype=bool)
+        present[self.file_ids] = True
+        return [name for name, has_rows in zip(self.filenames, present) if has_rows]
+
+    def has_file(self, filename: str) -> bool:
+        return filename in self.file_index
+
+    def _add_ranges(self, ranges: dict, file_ids: np.ndarray, first_row: int) -> dict:
+        """Add the runs of equal file ids in file_ids (rows from first_row on) to ranges."""
+        if not len(file_ids):
+            return ranges
+        breaks = np.flatnonzero(np.diff(file_ids) != 0) + 1
+        starts = np.concatenate([[0], breaks])
+        ends = np.concatenate([breaks, [len(file_ids)]])
+        for file_id, start, end in zip(file_ids[starts].tolist(), (starts + first_row).tolist(),
+                                       (ends + first_row).tolist()):
+            name = self.filenames[file_id]
+            previous = ranges.get(name, ())
+            if previous and previous[-1][1] == start:
+                ranges[name] = previous[:-1] + ((previous[-1][0], end),)
+            else:
+                ranges[name] = previous + ((start, end),)
+        return ranges
+
+    # -----------------------------
+    # Copy-on-write updates
+    # -----------------------------
+    def append(self, records: list[dict]) -> "ChunkStore":
+        """New store with records ({"filename", "chunk"}, optionally "page", "start", "end") added as rows at the end."""
+        filenames = list(self.filenames)
+        file_index = dict(self.file_index)
+        new_file_ids = np.empty(len(records), dtype="int32")
+        new_spans = np.full((len(records), 3), -1, dtype="int64")
+        encoded = []
+        for i, doc in enumerate(records):
+            file_id = file_index.get(doc["filename"])
+            if file_id is None:
+                file_id = file_index[doc["filename"]] = len(filenames)
+                filenames.append(doc["filename"])
+            new_file_ids[i] = file_id
+            if "start" in doc:
+                new_spans[i] = (doc["page"], doc["start"], doc["end"])
+            encoded.append(doc["chunk"].encode("utf-8"))
+
+        lengths = np.fromiter((len(b) for b in encoded), dtype="int64", count=len(encoded))
+        new_offsets = self.offsets[-1] + np.cumsum(lengths)
+        store = ChunkStore(
+            filenames,
+            np.concatenate([self.file_ids, new_file_ids]),
+            self.text + b"".join(encoded),
+            np.concatenate([self.offsets, new_offsets]),
+            np.concatenate([self.spans, new_spans]),
+            ranges={},
+        )
+        store.ranges = store._add_ranges(dict(self.ranges), new_file_ids, len(self))
+        return store
+
+    def take(self, keep: np.ndarray) -> "ChunkStore":
+        """New store with only the rows where keep is True; unused filenames are dropped."""
+        lengths = np.diff(self.offsets)
+        byte_mask = np.repeat(keep, lengths)
+        text = np.frombuffer(self.text, dtype="uint8")[byte_mask].tobytes()
+        offsets = np.concatenate([[0], np.cumsum(lengths[keep])]).astype("int64")
+
+        # Re-intern the remaining filenames so removed files do not linger in the table
+        used, file_ids = np.unique(self.file_ids[keep], return_inverse=True)
+        filenames = [self.filenames[i] for i in used.tolist()]
+        return ChunkStore(filenames, file_ids.astype("int32"), text, offsets, self.spans[keep])
+
+    @classmethod
+    def concat(cls, stores: list) -> "ChunkStore":
+        """One store with the rows of stores, in order (filenames re-interned across them)."""
+        file_index = {}
+        file_ids, offsets, base = [], [np.zeros(1, dtype="int64")], 0
+        for store in stores:
+            mapping = np.array([file_index.setdefault(name, len(file_index)) for name in store.filenames],
+                               dtype="int32")
+            file_ids.append(mapping[store.file_ids])
+            offsets.append(store.offsets[1:] + base)
+            base += int(store.offsets[-1])
+        filenames = sorted(file_index, key=file_index.get)
+        return cls(
+            filenames,
+            np.concatenate(file_ids) if file_ids else None,
+            b"".join(store.text for store in stores),
+            np.concatenate(offsets),
+            np.concatenate([store.spans for store in stores]) if stores else None,
+        )
+
+    def nbytes(self) -> int:
+        return self.file_ids.nbytes + self.offsets.nbytes + self.spans.nbytes + len(self.text)
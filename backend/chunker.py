@@ -0,0 +1,220 @@
+"""
+Streaming, sentence-aware chunking for rag_engine ingestion.
+
+A StreamingChunker is fed one page of text at a time and returns the chunks
+that are complete so far, so memory stays bounded by one chunk window plus
+the unfinished sentence, however large the document. Chunks:
+- are built from whole sentences (split further at word boundaries only when
+  a single sentence is longer than a chunk, and a word longer than a chunk,
+  such as a base64 blob or unspaced CJK text, at token boundaries), and end
+  early at a paragraph break once they are at least half full
+- are sized in tokens (CHUNK_TOKENS), counted locally with tiktoken
+- overlap by up to CHUNK_OVERLAP_TOKENS of trailing sentences
+- record their source span: the page they start on (1-based) and start/end
+  character offsets into the document text (pages joined by "\\n"), so
+  chunk.text == document[chunk.start:chunk.end]
+Sentence-aligned boundaries also keep unchanged passages producing identical
+chunks on re-ingestion, so their embeddings come from the embedding cache.
+"""
+
+import bisect
+import os
+import re
+from functools import lru_cache
+from typing import NamedTuple
+
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "200"))                  # ~800 characters of English text
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "25"))   # ~100 characters
+PARAGRAPH_MIN_FILL = 0.5  # end a chunk at a paragraph break once it is this full
+
+# Sentence end (punctuation plus any closing quotes/brackets, which stay in the sentence)
+# followed by whitespace, or a full-width (CJK) sentence end, which needs no whitespace after it,
+# or a blank line; group 1 / group 2 is the separator between sentences
+_BOUNDARY_RE = re.compile(r"(?:[.!?][\"')\]]*(?=\s)|[。！？][\"')\]」』）”’]*)(\s*)|(\n[ \t]*\n\s*)")
+_WORD_RE = re.compile(r"\S+\s*")
+
+
+# -----------------------------
+# Token counting
+# -----------------------------
+@lru_cache(maxsize=1)
+def get_encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None  # fall back to a character-based estimate
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+class Chunk(NamedTuple):
+    text: str
+    page: int   # page the chunk starts on, 1-based
+    start: int  # character offsets into the document text
+    end: int
+
+    def record(self, filename: str) -> dict:
+        """The chunk record stored by rag_engine / ChunkStore."""
+        return {"filename": filename, "chunk": self.text, "page": self.page, "start": self.start, "end": self.end}
+
+
+class StreamingChunker:
+    def __init__(self, chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS):
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.overlap_tokens = max(0, min(overlap_tokens, self.chunk_tokens // 2))
+
+        self._text = ""         # unconsumed document text, starting at document offset self._base
+        self._base = 0
+        self._scan = 0          # document offset where the next sentence starts
+        self._length = 0        # document length so far
+        self._page_starts = []  # document offset at which each retained page starts
+        self._page_numbers = []
+        self._pages = 0
+
+        self._window = []       # sentences of the chunk being built: (start, end, tokens)
+        self._window_tokens = 0
+
+    # -----------------------------
+    # Input
+    # -----------------------------
+    def feed(self, page: str) -> list[Chunk]:
+        """Add the next page; returns the chunks completed by it."""
+        if self._pages:
+            self._append("\n")
+        self._pages += 1
+        self._page_starts.append(self._length)
+        self._page_numbers.append(self._pages)
+        self._append(page)
+
+        chunks = []
+        for match in _BOUNDARY_RE.finditer(self._text, self._scan - self._base):
+            if match.end() == len(self._text):
+                break  # the sentence may continue on the next page
+            separator = 1 if match.group(1) is not None else 2
+            paragraph_end = match.group(separator).count("\n") >= 2
+            self._add_sentence(self._scan, self._base + match.start(separator), paragraph_end, chunks)
+            self._scan = self._base + match.end(separator)
+        self._trim()
+        return chunks
+
+    def close(self) -> list[Chunk]:
+        """Flush the last sentence and the final partial chunk."""
+        chunks = []
+        self._add_sentence(self._scan, self._length, True, chunks)
+        self._scan = self._length
+        if self._window:
+            chunks.append(self._emit())
+        self._window, self._window_tokens = [], 0
+        self._trim()
+        return chunks
+
+    def _append(self, text: str):
+        self._text += text
+        self._length += len(text)
+
+    # -----------------------------
+    # Sentences -> chunks
+    # -----------------------------
+    def _add_sentence(self, start: int, end: int, paragraph_end: bool, chunks: list):
+        # Skip surrounding whitespace so offsets point at the text itself
+        text = self._text[start - self._base:end - self._base]
+        stripped = text.strip()
+        if not stripped:
+            return
+        start += len(text) - len(text.lstrip())
+        end = start + len(stripped)
+
+        tokens = count_tokens(stripped)
+        pieces = [(start, end, tokens)] if tokens <= self.chunk_tokens else self._split_words(start, stripped)
+        for piece in pieces:
+            if self._window and self._window_tokens + piece[2] > self.chunk_tokens:
+                chunks.append(self._emit())
+                self._keep_overlap(piece[2])
+            self._window.append(piece)
+            self._window_tokens += piece[2]
+
+        if paragraph_end and self._window_tokens >= PARAGRAPH_MIN_FILL * self.chunk_tokens:
+            chunks.append(self._emit())
+            self._window, self._window_tokens = [], 0  # a paragraph break needs no overlap
+
+    def _split_words(self, start: int, sentence: str) -> list[tuple]:
+        """Break a sentence longer than a chunk into word-aligned pieces."""
+        pieces, piece_start, piece_tokens = [], start, 0
+        for match in _WORD_RE.finditer(sentence):
+            word_tokens = count_tokens(match.group())
+            if piece_tokens and piece_tokens + word_tokens > self.chunk_tokens:
+                piece_end = start + len(sentence[:match.start()].rstrip())
+                pieces.append((piece_start, piece_end, piece_tokens))
+                piece_tokens = 0
+            if word_tokens > self.chunk_tokens:
+                # A single word longer than a chunk: cut it at token boundaries
+                pieces.extend(self._split_tokens(start + match.start(), match.group().rstrip()))
+                continue
+            if not piece_tokens:
+                piece_start = start + match.start()
+            piece_tokens += word_tokens
+        if piece_tokens:
+            pieces.append((piece_start, start + len(sentence), piece_tokens))
+        return pieces
+
+    def _split_tokens(self, start: int, word: str) -> list[tuple]:
+        """Break a word longer than a chunk into pieces of at most chunk_tokens tokens."""
+        encoding = get_encoding()
+        if encoding is None:
+            step = 4 * max(1, self.chunk_tokens - 1)  # inverse of the character-based estimate
+            cuts = list(range(0, len(word), step))
+        else:
+            tokens = encoding.encode(word, disallowed_special=())
+            offsets = encoding.decode_with_offsets(tokens)[1]  # first character of each token
+            cuts = sorted({offsets[i] for i in range(0, len(tokens), self.chunk_tokens)})
+        pieces = []
+        for piece_start, piece_end in zip(cuts, cuts[1:] + [len(word)]):
+            text = word[piece_start:piece_end]
+            tokens = count_tokens(text)
+            if tokens > self.chunk_tokens and len(text) > 1:
+                # Re-encoding a cut piece can merge tokens differently; halve it until it fits
+                middle = len(text) // 2
+                pieces.extend(self._split_tokens(start + piece_start, text[:middle]))
+                pieces.extend(self._split_tokens(start + piece_start + middle, text[middle:]))
+            else:
+                pieces.append((start + piece_start, start + piece_end, tokens))
+        return pieces
+
+    def _keep_overlap(self, incoming_tokens: int):
+        """Start the next window with trailing sentences worth up to overlap_tokens (never the whole window)."""
+        kept, kept_tokens = [], 0
+        for piece in reversed(self._window[1:]):
+            if kept_tokens + piece[2] > self.overlap_tokens or kept_tokens + piece[2] + incoming_tokens > self.chunk_tokens:
+                break
+            kept.insert(0, piece)
+            kept_tokens += piece[2]
+        self._window, self._window_tokens = kept, kept_tokens
+
+    def _emit(self) -> Chunk:
+        start, end = self._window[0][0], self._window[-1][1]
+        page = self._page_numbers[bisect.bisect_right(self._page_starts, start) - 1]
+        return Chunk(self._text[start - self._base:end - self._base], page, start, end)
+
+    def _trim(self):
+        """Drop text (and page markers) that no pending sentence or window chunk needs any more."""
+        keep_from = self._window[0][0] if self._window else self._scan
+        if keep_from > self._base:
+            self._text = self._text[keep_from - self._base:]
+            self._base = keep_from
+        first = max(bisect.bisect_right(self._page_starts, keep_from) - 1, 0)
+        if first:
+            del self._page_starts[:first], self._page_numbers[:first]
+
+
+def iter_chunks(pages, chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS):
+    """Yield the Chunks of an iterable of page texts (e.g. [text] for a plain document)."""
+    chunker = StreamingChunker(chunk_tokens, overlap_tokens)
+    for page in pages:
+        yield from chunker.feed(page)
+    yield from chunker.close()
@@ -19,12 +19,12 @@ class FluencyMetric(GEval):
         kwargs.pop("evaluation_params", None)
         kwargs.pop('criteria', None)
         kwargs.pop('evaluation_steps', None)
-        kwargs.pop("async_mode", None)
+        async_mode = kwargs.pop("async_mode", True)
         super().__init__(
             name,
             evaluation_params,
             criteria=criteria,
             evaluation_steps=evaluation_steps,
-            async_mode=False,
+            async_mode=async_mode,
             **kwargs
         )
\ No newline at end of file
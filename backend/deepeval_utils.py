@@ -1,8 +1,17 @@
 """
 - DeepEval: few more pre-built and custom metrics
+- One long-lived evaluator: the judge model, its HTTP connection pools and the metric
+  instances are built once and reused; evaluate() always runs on the same thread and
+  event loop, so the async connection pool stays valid across evaluations
+- Metrics run in async mode; answers evaluated close together share one evaluate() call
 """
 
-from typing import Dict, Any
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List
+import httpx
 from deepeval.metrics import (
     FaithfulnessMetric,
     AnswerRelevancyMetric,
@@ -14,39 +23,108 @@ from deepeval_fluency import FluencyMetric  # import the custom metric
 from deepeval.models import GPTModel
 from deepeval.test_case import LLMTestCase
 from deepeval import evaluate
+from micro_batch import MicroBatcher
+from eval_scheduler import eval_scheduler
 
-def evaluate_rag(question: str, answer: str, context: list) -> Dict[str, Any]:
-    scores_dict = {}
-    try:
-        if context and answer.strip():
-            llm_model = GPTModel()
-            test_case = LLMTestCase(
+try:
+    from deepeval.evaluate.configs import AsyncConfig, DisplayConfig
+except ImportError:  # older deepeval releases take run_async / print_results keywords instead
+    AsyncConfig = DisplayConfig = None
+
+DEEPEVAL_BATCH_SIZE = int(os.getenv("DEEPEVAL_BATCH_SIZE", "8"))             # test cases per evaluate() call
+DEEPEVAL_BATCH_WAIT_MS = float(os.getenv("DEEPEVAL_BATCH_WAIT_MS", "200"))   # wait for more answers before evaluating
+DEEPEVAL_MAX_CONCURRENT = int(os.getenv("DEEPEVAL_MAX_CONCURRENT", "20"))    # judge calls in flight per evaluate()
+
+
+class DeepEvalService:
+    """Holds the shared judge model and metric templates; deepeval copies metrics per test case."""
+
+    def __init__(self):
+        self._judge = None
+        self._metrics = None
+        self._lock = threading.Lock()
+        # evaluate() drives its async metrics with the calling thread's event loop; one
+        # thread with one loop for its whole life lets the judge keep its async client
+        self._loop_thread = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="deepeval",
+            initializer=lambda: asyncio.set_event_loop(asyncio.new_event_loop()),
+        )
+        self.batcher = MicroBatcher(
+            self.evaluate_batch, DEEPEVAL_BATCH_SIZE, DEEPEVAL_BATCH_WAIT_MS,
+            run=eval_scheduler.run_in_pool, name="DeepEval",
+        )
+
+    def metrics(self) -> list:
+        with self._lock:
+            if self._metrics is None:
+                # One judge and one pair of HTTP connection pools for every metric and every evaluation;
+                # without them deepeval opens a new OpenAI client per judge call
+                self._judge = GPTModel(http_client=httpx.Client(), async_http_client=httpx.AsyncClient())
+                self._metrics = [
+                    FaithfulnessMetric(model=self._judge, async_mode=True),
+                    AnswerRelevancyMetric(model=self._judge, async_mode=True),
+                    HallucinationMetric(model=self._judge, async_mode=True),
+                    # SummarizationMetric(model=self._judge),
+                    ContextualRelevancyMetric(model=self._judge, async_mode=True),
+                    FluencyMetric(model=self._judge),
+                ]
+            return self._metrics
+
+    def evaluate_batch(self, items: List[tuple]) -> List[Dict[str, Any]]:
+        """Evaluate (question, answer, context) items in one evaluate() call; one scores dict per item."""
+        return self._loop_thread.submit(self._evaluate_batch, items).result()
+
+    def _evaluate_batch(self, items: List[tuple]) -> List[Dict[str, Any]]:
+        scores = [{} for _ in items]
+        cases = {
+            i: LLMTestCase(
                 input=question,
                 actual_output=answer,
                 context=context,
-                retrieval_context=context
+                retrieval_context=context,
+                name=str(i),
             )
-            metrics = [
-                FaithfulnessMetric(model=llm_model),
-                AnswerRelevancyMetric(model=llm_model),
-                HallucinationMetric(model=llm_model),
-                # SummarizationMetric(model=llm_model),
-                ContextualRelevancyMetric(model=llm_model),
-                FluencyMetric() # ✅ do not pass model here
-            ]
-            evaluation_results = evaluate([test_case], metrics)
+            for i, (question, answer, context) in enumerate(items)
+            if context and answer.strip()
+        }
+        if not cases:
+            return scores
+
+        try:
+            if AsyncConfig is not None:
+                evaluation_results = evaluate(
+                    list(cases.values()), self.metrics(),
+                    async_config=AsyncConfig(run_async=True, max_concurrent=DEEPEVAL_MAX_CONCURRENT),
+                    display_config=DisplayConfig(print_results=False, show_indicator=False),
+                )
+            else:
+                evaluation_results = evaluate(list(cases.values()), self.metrics(), run_async=True)
 
             test_results_list = getattr(evaluation_results, "test_results", evaluation_results)
-            for test_result in test_results_list:
-                for metric_data in getattr(test_result, "metrics_data", []):
-                    name = metric_data.name.replace(" ", "") + "Metric"
-                    scores_dict[name] = {
+            for position, test_result in enumerate(test_results_list):
+                # Async runs may finish out of order; map results back by test case name
+                name = getattr(test_result, "name", None)
+                i = int(name) if name is not None and str(name).isdigit() else list(cases)[position]
+                for metric_data in getattr(test_result, "metrics_data", None) or []:
+                    metric_name = metric_data.name.replace(" ", "") + "Metric"
+                    scores[i][metric_name] = {
                         "value": metric_data.score,
                         "reason": metric_data.reason,
                         "pass": metric_data.success
                     }
 
-    except Exception as e:
-        print(f"DeepEval evaluation failed: {e}")
+        except Exception as e:
+            print(f"DeepEval evaluation failed: {e}")
+
+        return scores
+
+    async def aevaluate(self, question: str, answer: str, context: list) -> Dict[str, Any]:
+        """Evaluate one answer, batched with other answers submitted around the same time."""
+        return await self.batcher.submit((question, answer, context))
+
 
-    return scores_dict
\ No newline at end of file
+deepeval_service = DeepEvalService()
+
+
+def evaluate_rag(question: str, answer: str, context: list) -> Dict[str, Any]:
+    return deepeval_service.evaluate_batch([(question, answer, context)])[0]
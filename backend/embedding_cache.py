@@ -0,0 +1,75 @@
+"""
+Persistent content-addressed embedding cache.
+
+Vectors are stored in SQLite keyed by (model name, SHA-256 of the text), so
+re-uploading a file, ingesting overlapping documents or asking the same
+question again never pays for the same embedding twice, across restarts too.
+"""
+
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL, hash BLOB NOT NULL, vector BLOB NOT NULL,"
+            " PRIMARY KEY (model, hash)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, model: str, texts: list[str]) -> list:
+        """Cached vector (float32 array) for each text, or None where it is not cached."""
+        hashes = [text_hash(t) for t in texts]
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch],
+                ).fetchall()
+                found.update(rows)
+
+            result = [np.frombuffer(found[h], dtype="float32") if h in found else None for h in hashes]
+            hit_count = sum(v is not None for v in result)
+            self.hits += hit_count
+            self.misses += len(result) - hit_count
+        return result
+
+    def put_many(self, model: str, texts: list[str], vectors):
+        rows = [
+            (model, text_hash(t), np.asarray(v, dtype="float32").tobytes())
+            for t, v in zip(texts, vectors)
+        ]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,201 @@
+"""
+Scheduler for background metric evaluation (DeepEval + RAGAS).
+
+Every answered question used to start its own evaluation task right away,
+so a burst of queries meant dozens of evaluations fighting over the default
+thread pool and the OpenAI rate limit. Evaluations now go through:
+- a bounded priority queue: interactive queries (/query, /query_stream) are
+  evaluated before batch work (/query_batch), and when the queue is full a
+  new interactive evaluation displaces the newest queued batch one
+- EVAL_CONCURRENCY worker tasks and a dedicated thread pool, so evaluation
+  never occupies the threads used by ingestion or query handling
+- an overflow policy when the queue is full: "drop" the new evaluation, or
+  "defer" it and retry a few times before dropping
+- yielding to interactive requests: a worker waits (up to EVAL_MAX_YIELD
+  seconds) while queries are in flight before starting the next evaluation
+Queue depth, waiting and running times are reported by stats().
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+EVAL_CONCURRENCY = int(os.getenv("EVAL_CONCURRENCY", "8"))          # evaluations running at once (batched together)
+EVAL_QUEUE_SIZE = int(os.getenv("EVAL_QUEUE_SIZE", "100"))          # waiting evaluations
+EVAL_OVERFLOW = os.getenv("EVAL_OVERFLOW", "drop")                  # "drop" or "defer"
+EVAL_DEFER_SECONDS = float(os.getenv("EVAL_DEFER_SECONDS", "30"))   # delay before a deferred retry
+EVAL_DEFER_ATTEMPTS = int(os.getenv("EVAL_DEFER_ATTEMPTS", "3"))    # retries before a deferred job is dropped
+EVAL_MAX_YIELD = float(os.getenv("EVAL_MAX_YIELD", "5"))            # max seconds to wait for queries to finish
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+
+class EvalJob:
+    def __init__(self, fn, args: tuple, priority: int, on_drop=None):
+        self.fn = fn  # coroutine function
+        self.args = args
+        self.priority = priority
+        self.on_drop = on_drop
+        self.attempts = 0
+        self.submitted_at = time.monotonic()
+
+
+class EvalScheduler:
+    def __init__(self, concurrency: int = EVAL_CONCURRENCY, max_queued: int = EVAL_QUEUE_SIZE,
+                 overflow: str = EVAL_OVERFLOW):
+        if overflow not in ("drop", "defer"):
+            raise ValueError(f"Unknown overflow policy {overflow!r}, expected 'drop' or 'defer'")
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.overflow = overflow
+        # DeepEval and RAGAS of one evaluation may run side by side
+        self.executor = ThreadPoolExecutor(max_workers=2 * concurrency, thread_name_prefix="eval")
+
+        self._pending = {PRIORITY_INTERACTIVE: deque(), PRIORITY_BATCH: deque()}
+        self._ready = None  # counts queued jobs, workers wait on it
+        self._workers = []
+        self._deferred = 0  # jobs waiting for a retry
+        self._interactive = 0
+        self._idle = None  # set while no interactive request is in flight
+
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.deferrals = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.max_wait = 0.0
+
+    def _start(self):
+        # Created lazily: the queue and workers need the running event loop
+        if self._ready is None:
+            self._ready = asyncio.Semaphore(0)
+            self._idle = asyncio.Event()
+            self._idle.set()
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    # -----------------------------
+    # Submitting work
+    # -----------------------------
+    def submit(self, fn, *args, priority: int = PRIORITY_INTERACTIVE, on_drop=None) -> bool:
+        """
+        Queue fn(*args) (a coroutine function). on_drop() is called if the job
+        is dropped because the queue stays full. Returns False if it was dropped right away.
+        """
+        self._start()
+        return self._enqueue(EvalJob(fn, args, priority, on_drop))
+
+    def queued(self) -> int:
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    def _enqueue(self, job: EvalJob) -> bool:
+        if self.queued() >= self.max_queued:
+            # Make room by displacing the newest job of a lower priority, if any
+            lower = [p for p in sorted(self._pending, reverse=True) if p > job.priority and self._pending[p]]
+            if not lower:
+                return self._overflow(job)
+            self._overflow(self._pending[lower[0]].pop())
+            self._pending[job.priority].append(job)  # takes over the displaced job's slot
+            return True
+
+        self._pending[job.priority].append(job)
+        self._ready.release()
+        return True
+
+    def _overflow(self, job: EvalJob) -> bool:
+        """Defer or drop a job that found the queue full."""
+        if self.overflow == "defer" and job.attempts < EVAL_DEFER_ATTEMPTS:
+            job.attempts += 1
+            self.deferrals += 1
+            self._deferred += 1
+            asyncio.get_running_loop().call_later(EVAL_DEFER_SECONDS, self._retry, job)
+            return True
+
+        self.dropped += 1
+        print(f"[EvalScheduler] Queue full, dropped evaluation (priority {job.priority})")
+        if job.on_drop:
+            job.on_drop()
+        return False
+
+    def _retry(self, job: EvalJob):
+        self._deferred -= 1
+        self._enqueue(job)
+
+    async def run_in_pool(self, fn, *args):
+        """Run a blocking evaluation step on the scheduler's own thread pool."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    # -----------------------------
+    # Interactive priority
+    # -----------------------------
+    @asynccontextmanager
+    async def interactive(self):
+        """Wrap user-facing request handling; workers hold off new evaluations meanwhile."""
+        self._start()
+        self._interactive += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self._interactive -= 1
+            if not self._interactive:
+                self._idle.set()
+
+    async def _yield_to_interactive(self):
+        if self._interactive:
+            try:
+                await asyncio.wait_for(self._idle.wait(), EVAL_MAX_YIELD)
+            except asyncio.TimeoutError:
+                pass  # never starve evaluations completely
+
+    # -----------------------------
+    # Workers
+    # -----------------------------
+    async def _worker(self):
+        while True:
+            await self._ready.acquire()
+            job = next(jobs.popleft() for _, jobs in sorted(self._pending.items()) if jobs)
+            await self._yield_to_interactive()
+
+            started = time.monotonic()
+            waited = started - job.submitted_at
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+            self.running += 1
+            try:
+                await job.fn(*job.args)
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"[EvalScheduler] Evaluation failed: {e}")
+            finally:
+                self.running -= 1
+                self.run_time += time.monotonic() - started
+
+    def stats(self) -> dict:
+        finished = self.completed + self.failed
+        started = finished + self.running
+        return {
+            "concurrency": self.concurrency,
+            "queued": self.queued(),
+            "max_queued": self.max_queued,
+            "overflow": self.overflow,
+            "deferred": self._deferred,
+            "running": self.running,
+            "interactive_in_flight": self._interactive,
+            "completed": self.completed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "deferrals": self.deferrals,
+            "avg_wait_s": self.wait_time / started if started else 0.0,
+            "max_wait_s": self.max_wait,
+            "avg_run_s": self.run_time / finished if finished else 0.0,
+        }
+
+
+eval_scheduler = EvalScheduler()
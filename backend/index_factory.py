@@ -0,0 +1,145 @@
+"""
+Configurable FAISS index backends for rag_engine.
+
+Backends (FAISS_INDEX_TYPE):
+- "flat":     exact brute-force L2 search (default)
+- "ivf_flat": inverted file lists, exact distances inside the probed lists
+- "ivf_pq":   inverted file lists with product-quantized vectors (lowest memory)
+- "hnsw":     graph-based search, no training needed, no in-place removal
+
+Every index is wrapped in IndexIDMap2 so it is addressed by chunk id.
+IVF backends need training; until enough vectors exist to train them the
+factory falls back to a flat index, and the background merge in rag_engine
+(see segments.plan_merge) builds the configured backend once the corpus is
+large enough. Search-time knobs (nprobe, efSearch) are applied per query.
+"""
+
+import os
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat")
+IVF_NLIST = int(os.getenv("FAISS_IVF_NLIST", "1024"))
+PQ_M = int(os.getenv("FAISS_PQ_M", "64"))           # sub-quantizers, must divide the dimension
+PQ_NBITS = int(os.getenv("FAISS_PQ_NBITS", "8"))
+HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("FAISS_HNSW_EF_CONSTRUCTION", "200"))
+NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+TRAIN_SAMPLE = int(os.getenv("FAISS_TRAIN_SAMPLE", "100000"))
+
+POINTS_PER_CENTROID = 39  # FAISS warns below this many training points per centroid
+
+
+# -----------------------------
+# Index construction
+# -----------------------------
+def factory_string(kind: str, dim: int) -> str:
+    if kind == "flat":
+        return "Flat"
+    if kind == "ivf_flat":
+        return f"IVF{IVF_NLIST},Flat"
+    if kind == "ivf_pq":
+        if dim % PQ_M:
+            raise ValueError(f"FAISS_PQ_M={PQ_M} must divide the embedding dimension {dim}")
+        return f"IVF{IVF_NLIST},PQ{PQ_M}x{PQ_NBITS}"
+    if kind == "hnsw":
+        return f"HNSW{HNSW_M}"
+    raise ValueError(f"Unknown FAISS_INDEX_TYPE {kind!r}, expected one of {INDEX_TYPES}")
+
+
+def min_training_points(kind: str) -> int:
+    """Number of vectors needed before a backend can be trained."""
+    if kind == "ivf_flat":
+        return IVF_NLIST * POINTS_PER_CENTROID
+    if kind == "ivf_pq":
+        return max(IVF_NLIST, 2 ** PQ_NBITS) * POINTS_PER_CENTROID
+    return 0
+
+
+def create_index(dim: int, kind: str = None):
+    """Create an empty (possibly untrained) index of the given kind."""
+    base = faiss.index_factory(dim, factory_string(kind or INDEX_TYPE, dim))
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    return faiss.IndexIDMap2(base)
+
+
+def train_index(index, vectors: np.ndarray):
+    """Training hook: fit IVF centroids / PQ codebooks on a sample of the vectors."""
+    if index.is_trained:
+        return
+    if len(vectors) > TRAIN_SAMPLE:
+        rng = np.random.default_rng(0)
+        vectors = vectors[np.sort(rng.choice(len(vectors), TRAIN_SAMPLE, replace=False))]
+    index.train(np.ascontiguousarray(vectors, dtype="float32"))
+
+
+def build_index(vectors: np.ndarray, ids: np.ndarray, kind: str = None, trained=None):
+    """
+    Rebuild hook: build a complete index from stored vectors.
+    Falls back to a flat index when there are too few vectors to train the requested backend.
+    trained: an index of the same kind whose training (IVF centroids / PQ codebooks) is
+    reused instead of fitting them again, e.g. the base being compacted.
+    """
+    kind = kind or INDEX_TYPE
+    if len(vectors) < min_training_points(kind):
+        kind = "flat"
+
+    if trained is not None and kind in ("ivf_flat", "ivf_pq") and index_kind(trained) == kind:
+        index = writable_copy(trained)
+        index.reset()
+    else:
+        index = create_index(vectors.shape[1], kind)
+        train_index(index, vectors)
+    index.add_with_ids(np.ascontiguousarray(vectors, dtype="float32"), ids)
+    return index
+
+
+def writable_copy(index):
+    """
+    Owned, mutable copy of an index for copy-on-write updates. A round trip
+    through serialization instead of faiss.clone_index, because clones of an
+    index loaded with IO_FLAG_MMAP_IFC still view the mapped file and abort on add/remove.
+    """
+    return faiss.deserialize_index(faiss.serialize_index(index))
+
+
+# -----------------------------
+# Index inspection
+# -----------------------------
+def index_kind(index) -> str:
+    base = faiss.downcast_index(index.index if isinstance(index, faiss.IndexIDMap) else index)
+    if isinstance(base, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(base, faiss.IndexIVFFlat):
+        return "ivf_flat"
+    if isinstance(base, faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+# -----------------------------
+# Search-time parameters
+# -----------------------------
+def search_params(index, nprobe: int = None, ef_search: int = None, selector=None):
+    """
+    Per-query search parameters for the index backend (None for flat without a selector).
+    selector (e.g. faiss.IDSelectorBatch of chunk ids) restricts the search; the
+    caller must keep it referenced until the search returns.
+    """
+    kind = index_kind(index)
+    if kind in ("ivf_flat", "ivf_pq"):
+        params = faiss.SearchParametersIVF(nprobe=nprobe or NPROBE)
+    elif kind == "hnsw":
+        params = faiss.SearchParametersHNSW(efSearch=ef_search or EF_SEARCH)
+    elif selector is not None:
+        params = faiss.SearchParameters()
+    else:
+        return None
+    if selector is not None:
+        params.sel = selector
+    return params
@@ -0,0 +1,183 @@
+"""
+Background ingestion jobs.
+
+Uploads are queued as jobs and processed by a bounded pool of asyncio
+workers, so /upload and /upload_files return a job id immediately instead of
+waiting for every chunk to be embedded. Each job tracks pages parsed, chunks
+created / embedded / indexed, a percent-done estimate and per-file errors,
+served by the /jobs endpoints.
+
+A file's chunks are committed to the index in one step once all of them are
+embedded, so queries running meanwhile keep seeing the last committed corpus.
+"""
+
+import asyncio
+import itertools
+import os
+import time
+from collections import OrderedDict
+
+import rag_engine
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))            # jobs processed concurrently
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "100"))    # pending jobs before uploads are refused
+INGEST_JOB_HISTORY = int(os.getenv("INGEST_JOB_HISTORY", "200"))  # finished jobs kept for status queries
+
+
+class FileProgress:
+    def __init__(self):
+        self.pages_total = None
+        self.pages_done = 0
+        self.chunks_created = 0
+        self.chunks_embedded = 0
+        self.chunks_indexed = 0
+        self.done = False
+
+    def fraction(self) -> float:
+        """Chunks embedded over the projected total (chunks so far scaled by the share of pages parsed)."""
+        if self.done:
+            return 1.0
+        if not self.pages_total or not self.chunks_created:
+            return 0.0
+        parsed = min(self.pages_done / self.pages_total, 1.0)
+        # Keep the last step (committing to the index) for done
+        return min(parsed * self.chunks_embedded / self.chunks_created, 0.99)
+
+
+class IngestJob:
+    def __init__(self, job_id: str, kind: str, items: list):
+        self.id = job_id
+        self.kind = kind    # "files" (items are (filename, bytes)) or "texts" (items are (name, str))
+        self.items = items
+        self.status = "queued"  # queued -> running -> done | failed
+        self.files = {name: FileProgress() for name, _ in items}
+        self.added = []
+        self.errors = []
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def progress_callback(self, name: str):
+        """progress(event, value) callback for rag_engine.aadd_file / aadd_text."""
+        file = self.files[name]
+
+        def progress(event, value):
+            if event == "pages":
+                file.pages_total = value
+            elif event == "page":
+                file.pages_done += value
+            elif event == "chunks":
+                file.chunks_created += value
+            elif event == "embedded":
+                file.chunks_embedded += value
+            elif event == "indexed":
+                file.chunks_indexed += value
+            elif event == "error":
+                self.errors.append(value)
+        return progress
+
+    def percent(self) -> float:
+        if not self.files:
+            return 100.0
+        return round(100 * sum(f.fraction() for f in self.files.values()) / len(self.files), 1)
+
+    def to_dict(self) -> dict:
+        files = self.files.values()
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "percent": self.percent(),
+            "files_total": len(self.files),
+            "files_done": sum(f.done for f in files),
+            "pages_total": sum(f.pages_total or 0 for f in files),
+            "pages_done": sum(f.pages_done for f in files),
+            "chunks_created": sum(f.chunks_created for f in files),
+            "chunks_embedded": sum(f.chunks_embedded for f in files),
+            "chunks_indexed": sum(f.chunks_indexed for f in files),
+            "added": self.added,
+            "errors": self.errors,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestQueue:
+    def __init__(self, workers: int = INGEST_WORKERS, max_pending: int = INGEST_QUEUE_SIZE,
+                 history: int = INGEST_JOB_HISTORY):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.history = history
+        self.jobs = OrderedDict()  # job id -> IngestJob; insertion order = age
+        self._queue = None
+        self._tasks = []
+        self._ids = itertools.count(1)
+
+    def _start(self):
+        # Created lazily: the queue and workers need the running event loop
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, kind: str, items: list) -> IngestJob:
+        """Queue a job; raises asyncio.QueueFull when max_pending jobs are already waiting."""
+        self._start()
+        job = IngestJob(f"job-{next(self._ids)}", kind, items)
+        self._queue.put_nowait(job)
+        self.jobs[job.id] = job
+        self._prune()
+        return job
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            except Exception as e:
+                job.errors.append(str(e))
+                job.status = "failed"
+                print(f"[IngestJobs] {job.id} failed: {e}")
+            finally:
+                job.items = None  # release the uploaded bytes
+                job.finished_at = time.time()
+                self._queue.task_done()
+
+    async def _run(self, job: IngestJob):
+        job.status = "running"
+        job.started_at = time.time()
+
+        add = rag_engine.aadd_file if job.kind == "files" else rag_engine.aadd_text
+
+        async def add_one(name, content):
+            count = await add(name, content, job.progress_callback(name))
+            job.files[name].done = True
+            if count:
+                job.added.append(name)
+            elif not any(e.startswith(f"{name}:") for e in job.errors):
+                job.errors.append(f"{name}: no text extracted")
+
+        # Files of one job are extracted and embedded concurrently, like the old inline upload
+        await asyncio.gather(*(add_one(name, content) for name, content in job.items))
+
+        job.status = "done" if job.added or not job.errors else "failed"
+        print(f"[IngestJobs] {job.id} {job.status}: {len(job.added)}/{len(job.files)} added")
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(0, len(self.jobs) - self.history)]:
+            del self.jobs[job_id]
+
+    def stats(self) -> dict:
+        statuses = [job.status for job in self.jobs.values()]
+        return {
+            "workers": self.workers,
+            "pending": self._queue.qsize() if self._queue else 0,
+            "max_pending": self.max_pending,
+            **{status: statuses.count(status) for status in ("queued", "running", "done", "failed")},
+        }
+
+
+ingest_queue = IngestQueue()
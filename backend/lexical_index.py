@@ -0,0 +1,189 @@
+"""
+In-process BM25 inverted index over chunk texts.
+
+Postings are kept per term as (chunk ids, term frequencies, document
+lengths) NumPy arrays, so the index is addressed by chunk id alone and never
+has to follow how a snapshot lays out its rows. Like the rest of a
+rag_engine snapshot, a LexicalIndex is never mutated: add() and remove()
+return a new index that shares every posting list they did not touch, so
+updates cost O(postings of the affected terms), not O(corpus).
+An index restored at startup is built by a background thread (build_in_background)
+so loading the store does not wait for it; until it is ready searches find nothing.
+
+Tokens are lowercased words; compound tokens such as "ERR-1042" or
+"v2.3.1" are indexed whole and also split into their parts, so exact
+lookups of IDs, error codes and names match.
+"""
+
+import math
+import re
+import threading
+
+import numpy as np
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"\w+(?:[-.:/]\w+)*")
+# Question words left out of query_weight, so "what is ERR-1042?" weighs the same as "ERR-1042"
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it me of on or should that the this "
+    "to was what when where which who why will with you".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    tokens = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        tokens.append(token)
+        if not token.isalnum():
+            tokens.extend(part for part in re.split(r"[-.:/_]", token) if part)
+    return tokens
+
+
+class LexicalIndex:
+    def __init__(self, postings: dict = None, n_docs: int = 0, total_length: int = 0):
+        self.postings = postings if postings is not None else {}  # term -> (int64 chunk ids, int32 tfs, int32 doc lengths)
+        self.n_docs = n_docs              # indexed chunks
+        self.total_length = total_length  # tokens over all indexed chunks
+        self._built = None  # threading.Event while a background build is running
+
+    def __len__(self):
+        self.wait()
+        return self.n_docs
+
+    @classmethod
+    def build_in_background(cls, load_chunks) -> "LexicalIndex":
+        """Index of the (ids, texts) returned by load_chunks(), filled in by a daemon thread."""
+        index = cls()
+        index._built = threading.Event()
+
+        def build():
+            try:
+                built = cls().add(*load_chunks())
+                index.postings, index.n_docs, index.total_length = built.postings, built.n_docs, built.total_length
+                print(f"[LexicalIndex] Built BM25 index over {built.n_docs} chunks")
+            finally:
+                index._built.set()
+
+        threading.Thread(target=build, name="bm25-build", daemon=True).start()
+        return index
+
+    def ready(self) -> bool:
+        return self._built is None or self._built.is_set()
+
+    def wait(self):
+        """Block until a background build has finished (no-op otherwise)."""
+        if self._built is not None:
+            self._built.wait()
+
+    @staticmethod
+    def _term_counts(ids, texts) -> tuple:
+        """(term -> ([chunk ids], [tfs], [doc lengths]), total tokens) for the given chunks."""
+        counts, total = {}, 0
+        for chunk_id, text in zip(ids, texts):
+            tokens = tokenize(text)
+            total += len(tokens)
+            tfs = {}
+            for token in tokens:
+                tfs[token] = tfs.get(token, 0) + 1
+            for term, tf in tfs.items():
+                term_ids, term_tfs, term_lengths = counts.setdefault(term, ([], [], []))
+                term_ids.append(chunk_id)
+                term_tfs.append(tf)
+                term_lengths.append(len(tokens))
+        return counts, total
+
+    # -----------------------------
+    # Copy-on-write updates
+    # -----------------------------
+    def add(self, new_ids: np.ndarray, texts: list[str]) -> "LexicalIndex":
+        """New index with chunks added; new_ids must be larger than every indexed id (postings stay sorted)."""
+        self.wait()
+        postings = dict(self.postings)
+        counts, total = self._term_counts(np.asarray(new_ids).tolist(), texts)
+        for term, (ids, tfs, lengths) in counts.items():
+            posting = (np.array(ids, dtype="int64"), np.array(tfs, dtype="int32"), np.array(lengths, dtype="int32"))
+            if term in postings:
+                posting = tuple(np.concatenate([old, new]) for old, new in zip(postings[term], posting))
+            postings[term] = posting
+        return LexicalIndex(postings, self.n_docs + len(texts), self.total_length + total)
+
+    def remove(self, removed_ids: np.ndarray, removed_texts: list[str]) -> "LexicalIndex":
+        """New index without the removed chunks (removed_texts are their texts, used to find their terms)."""
+        self.wait()
+        postings = dict(self.postings)
+        counts, total = self._term_counts(np.asarray(removed_ids).tolist(), removed_texts)
+        for term in counts:
+            ids, tfs, lengths = postings[term]
+            live = ~np.isin(ids, removed_ids)
+            if live.any():
+                postings[term] = (ids[live], tfs[live], lengths[live])
+            else:
+                del postings[term]
+        return LexicalIndex(postings, self.n_docs - len(removed_texts), self.total_length - total)
+
+    # -----------------------------
+    # Search
+    # -----------------------------
+    def search(self, query: str, k: int, id_ranges: np.ndarray = None):
+        """
+        BM25 top-k. id_ranges (sorted [first_id, end_id) chunk id ranges, e.g. a
+        segments.Scope), if given, limits the hits to those chunks.
+        Returns (chunk ids, scores), best first; no hits while a background build is running.
+        """
+        n_docs = self.n_docs if self.ready() else 0
+        if not n_docs or (id_ranges is not None and not len(id_ranges)):
+            return np.empty(0, dtype="int64"), np.empty(0, dtype="float32")
+        avg_len = self.total_length / n_docs or 1.0
+
+        all_ids, all_scores = [], []
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            ids, tfs, lengths = posting
+            idf = _idf(n_docs, len(ids))
+            if id_ranges is not None:
+                run = np.searchsorted(id_ranges[:, 0], ids, side="right") - 1
+                allowed = (run >= 0) & (ids < id_ranges[np.maximum(run, 0), 1])
+                ids, tfs, lengths = ids[allowed], tfs[allowed], lengths[allowed]
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / avg_len)
+            all_ids.append(ids)
+            all_scores.append(idf * tfs * (BM25_K1 + 1) / (tfs + norm))
+        if not all_ids:
+            return np.empty(0, dtype="int64"), np.empty(0, dtype="float32")
+
+        # Sum the per-term contributions of every matching chunk
+        ids, inverse = np.unique(np.concatenate(all_ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores))
+        top = np.argsort(-scores, kind="stable")[:k]
+        return ids[top], scores[top].astype("float32")
+
+    def query_weight(self, query: str) -> float:
+        """
+        Score of an average-length chunk containing each of the query's non-stopword terms
+        once: the sum of their idfs, with terms found nowhere at the idf of an unseen term.
+        Search scores divided by it are comparable across queries and corpus sizes
+        (about 1 for a chunk matching the whole query, less for a partial match).
+        """
+        n_docs = self.n_docs if self.ready() else 0
+        weight = 0.0
+        for term in set(tokenize(query)) - STOPWORDS:
+            posting = self.postings.get(term)
+            weight += _idf(n_docs, len(posting[0]) if posting is not None else 0)
+        return weight
+
+
+def _idf(n_docs: int, doc_freq: int) -> float:
+    return math.log(1 + (n_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+
+def reciprocal_rank_fusion(rankings: list, k: int, rrf_k: int = 60) -> np.ndarray:
+    """Fuse several best-first row rankings: score(row) = sum over rankings of 1 / (rrf_k + rank)."""
+    scores = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking.tolist()):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (rrf_k + rank + 1)
+    fused = sorted(scores, key=scores.get, reverse=True)[:k]
+    return np.array(fused, dtype="int64")
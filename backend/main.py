@@ -1,17 +1,35 @@
 """
 - async ragas and deepeval
 - only ragas reasoning
+- /query_stream: answer tokens streamed via Server-Sent Events
+- uploads run as background ingestion jobs, progress at /jobs/{job_id}
+- /query_batch: many questions, one embedding request and one index search
 """
 
 from fastapi import FastAPI, UploadFile, File
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from rag_engine import add_documents, remove_documents, extract_text_from_file
-from ragas_engine import ragas_generate
+import json
+import os
+import asyncio
+from rag_engine import (
+    remove_documents, load_vectorstore, get_corpus_version,
+    aembed_query, aembed_queries, aretrieve_batch, wants_summary, lexical_fast_path_records,
+)
+from ragas_engine import ragas_generate, ragas_generate_stream, ragas_batcher
+from deepeval_utils import deepeval_service
 from fastapi.middleware.cors import CORSMiddleware
-from cache import answers_cache
+from cache import answers_cache, cache_key
+from semantic_cache import semantic_cache
+from ingest_jobs import ingest_queue
+from eval_scheduler import eval_scheduler, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+import rag_engine
 
 app = FastAPI(title="Async RAG + DeepEval + RAGAS")
 
+# Restore previously uploaded documents (memory-mapped, no re-embedding)
+load_vectorstore()
+
 # CORS
 origins = ["http://localhost:3000"]
 app.add_middleware(
@@ -28,38 +46,74 @@ class Docs(BaseModel):
 
 class Question(BaseModel):
     question: str
+    files: list[str] | None = None  # only search these uploaded files
+
+class Questions(BaseModel):
+    questions: list[str]
+    stream: bool = False
 
 
 # -----------------------------
 # Upload documents
 # -----------------------------
+def queue_ingest(kind: str, items: list):
+    if not items:
+        return {"status": "No valid text extracted from uploaded files."}
+    try:
+        job = ingest_queue.submit(kind, items)
+    except asyncio.QueueFull:
+        return {"error": "Ingestion queue is full, try again later."}
+    names = [name for name, _ in items]
+    return {"status": "Queued", "job_id": job.id, "count": len(names), "files": names}
+
+_next_doc_number = None  # next free doc_N name for raw text uploads
+
+
+def reserve_doc_names(count: int) -> list[str]:
+    """
+    Unique doc_N names, reserved when the upload is queued (not when its job
+    commits), so uploads queued back to back never share a name. Numbering
+    resumes after the highest doc_N already in the loaded corpus.
+    """
+    global _next_doc_number
+    if _next_doc_number is None:
+        numbers = [int(name[4:]) for name in rag_engine.current_snapshot().segments.files()
+                   if name.startswith("doc_") and name[4:].isdigit()]
+        _next_doc_number = max(numbers, default=-1) + 1
+    names = [f"doc_{_next_doc_number + i}" for i in range(count)]
+    _next_doc_number += count
+    return names
+
 @app.post("/upload")
 async def upload_docs(req: Docs):
-    add_documents(req.texts)
-    return {"status": "Documents added", "count": len(req.texts)}
+    return queue_ingest("texts", list(zip(reserve_doc_names(len(req.texts)), req.texts)))
 
 @app.post("/upload_files")
 async def upload_files(files: list[UploadFile] = File(...)):
-    all_texts = []
-    filenames = []
-
+    contents = []
     for file in files:
         try:
-            content = await file.read()
-            extracted_text = extract_text_from_file(file.filename, content)
+            contents.append((file.filename, await file.read()))
         except Exception as e:
             print(f"Error reading file {file.filename}: {e}")
-            continue
 
-        if extracted_text.strip():
-            all_texts.append(extracted_text)
-            filenames.append(file.filename)
+    # Extraction and embedding run in the background; poll /jobs/{job_id} for progress
+    return queue_ingest("files", contents)
 
-    if not all_texts:
-        return {"status": "No valid text extracted from uploaded files."}
 
-    add_documents(all_texts, filenames=filenames)
-    return {"status": "Files processed", "count": len(all_texts), "files": filenames}
+# -----------------------------
+# Ingestion job status
+# -----------------------------
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = ingest_queue.get(job_id)
+    if job is None:
+        return {"error": f"Unknown job {job_id}."}
+    return job.to_dict()
+
+@app.get("/jobs")
+async def list_jobs():
+    return {"stats": ingest_queue.stats(), "jobs": [job.to_dict() for job in ingest_queue.jobs.values()]}
 
 
 # -----------------------------
@@ -67,30 +121,88 @@ async def upload_files(files: list[UploadFile] = File(...)):
 # -----------------------------
 @app.post("/remove_files")
 async def remove_files(filenames: list[str]):
-    removed_files = remove_documents(filenames)
+    # Runs off the event loop; queries keep searching the previous snapshot meanwhile
+    removed_files, old_version, new_version = await asyncio.to_thread(remove_documents, filenames, return_versions=True)
     if not removed_files:
         return {"status": "No documents removed. Check filenames."}
+
+    # Drop answers built from the removed files; the rest stay valid for the new corpus version
+    answers_cache.invalidate(removed_files)
+    answers_cache.migrate_version(old_version, new_version)
     return {"status": f"Removed {', '.join(removed_files)} successfully."}
 
 
+# -----------------------------
+# Cached answer lookup (exact, then semantic)
+# -----------------------------
+async def lookup_cached_answer(question: str, key, q_embed=None, scoped: bool = False):
+    """
+    Returns (cached_entry or None, question embedding or None, retrieved chunks or None).
+    Answers are keyed by corpus version, so a hit is never stale. On a miss the
+    question embedding is returned so retrieval does not embed it again.
+    Pass q_embed if the question is already embedded. Questions that BM25
+    answers confidently skip the semantic lookup (and the embedding call) and
+    come back with their chunks, so generation does not search again;
+    file-scoped questions (scoped=True), whose answers are not shared, skip it too.
+    """
+    cached = answers_cache.get(key)
+    if cached and cached["relevant"]:
+        return cached, q_embed, None
+    if scoped:
+        return None, q_embed, None
+
+    if q_embed is None:
+        retrieved = await asyncio.to_thread(lexical_fast_path_records, question, 3)
+        if retrieved is not None:
+            return None, None, retrieved
+        q_embed = await aembed_query(question)
+    version = key[1]
+    match, similarity = semantic_cache.lookup(
+        q_embed, wants_summary(question), lambda q: cache_key(q, version) in answers_cache
+    )
+    if match is not None:
+        print(f"[SemanticCache] '{question}' matched '{match}' ({similarity:.3f})")
+        # Share the entry under this phrasing too, so /metrics polling works for it
+        answers_cache.alias(key, cache_key(match, version))
+        return answers_cache.get(key), q_embed, None
+    return None, q_embed, None
+
+
 # -----------------------------
 # Query endpoint (RAGAS reasoning)
 # -----------------------------
-@app.post("/query")
-async def query_ragas(req: Question):
-    answer, context, reasoning, relevant = await ragas_generate(req.question)
+async def answer_question(question: str, key, q_embed=None, retrieved=None, priority: int = PRIORITY_INTERACTIVE,
+                          files: list[str] = None):
+    """Cache lookup, then generation on a miss; returns the /query response body."""
+    cached, q_embed, fast_path = await lookup_cached_answer(question, key, q_embed, scoped=files is not None)
+    if cached:
+        return {
+            "question": question,
+            "answer": cached["answer"],
+            "context": cached["context"],
+            "reasoning": cached["reasoning"],
+            "metrics": cached["metrics"],
+            "message": "Served from cache."
+        }
+
+    answer, context, reasoning, relevant, sources = await ragas_generate(
+        question, key=key, q_embed=q_embed, retrieved=retrieved if retrieved is not None else fast_path,
+        priority=priority, files=files,
+    )
+    if relevant and q_embed is not None and files is None:
+        semantic_cache.add(q_embed, question, wants_summary(question))
 
     # Save initial response in cache
-    answers_cache[req.question] = {
+    answers_cache.set(key, {
         "answer": answer,
         "context": context,
         "relevant": relevant,
         "metrics": None,       # metrics will be updated asynchronously
         "reasoning": reasoning
-    }
+    }, tags=sources)
 
     return {
-        "question": req.question,
+        "question": question,
         "answer": answer,
         "context": context,
         "reasoning": reasoning,
@@ -98,13 +210,121 @@ async def query_ragas(req: Question):
         "message": "Metrics and reasoning will appear shortly."
     }
 
+@app.post("/query")
+async def query_ragas(req: Question):
+    # Background evaluations hold off while interactive queries are in flight
+    async with eval_scheduler.interactive():
+        key = cache_key(req.question, await asyncio.to_thread(get_corpus_version), req.files)
+        return await answer_question(req.question, key, files=req.files)
+
+
+# -----------------------------
+# Batch query endpoint
+# -----------------------------
+BATCH_QUERY_CONCURRENCY = int(os.getenv("BATCH_QUERY_CONCURRENCY", "8"))  # questions generated at once
+
+@app.post("/query_batch")
+async def query_batch(req: Questions):
+    """
+    Answer many questions at once. Uncached questions are embedded in one
+    request and searched as one matrix; generation runs BATCH_QUERY_CONCURRENCY
+    at a time. Results keep the input order, either as {"results": [...]} or,
+    with "stream": true, as one "result" Server-Sent Event per question
+    followed by "done". Repeated questions are answered once.
+    """
+    questions = list(dict.fromkeys(req.questions))
+    version = await asyncio.to_thread(get_corpus_version)
+    keys = [cache_key(q, version) for q in questions]
+
+    q_embeds = await aembed_queries(questions) if questions else None
+    misses = [i for i, key in enumerate(keys) if key not in answers_cache]
+    retrieved = dict(zip(misses, await aretrieve_batch(
+        [questions[i] for i in misses], q_embeds=q_embeds[misses] if misses else None
+    )))
+
+    semaphore = asyncio.Semaphore(BATCH_QUERY_CONCURRENCY)
+
+    async def answer(i):
+        async with semaphore:
+            return await answer_question(questions[i], keys[i], q_embeds[i:i + 1], retrieved.get(i), PRIORITY_BATCH)
+
+    tasks = {q: asyncio.create_task(answer(i)) for i, q in enumerate(questions)}
+
+    if not req.stream:
+        try:
+            results = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+        finally:
+            for task in tasks.values():
+                task.cancel()
+        return {"results": [results[q] for q in req.questions]}
+
+    async def event_stream():
+        try:
+            for i, q in enumerate(req.questions):
+                result = await tasks[q]
+                yield f"event: result\ndata: {json.dumps({'index': i, **result})}\n\n"
+            yield f"event: done\ndata: {json.dumps({'count': len(req.questions)})}\n\n"
+        finally:
+            # Client disconnected: stop generating the remaining answers
+            for task in tasks.values():
+                task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# -----------------------------
+# Streaming query endpoint (Server-Sent Events)
+# -----------------------------
+@app.post("/query_stream")
+async def query_ragas_stream(req: Question):
+    """
+    Same as /query, streamed as Server-Sent Events:
+    "context" first, then one "token" event per answer piece, then "reasoning" and "done".
+    """
+    key = cache_key(req.question, await asyncio.to_thread(get_corpus_version), req.files)
+
+    async def event_stream():
+        async with eval_scheduler.interactive():
+            cached, q_embed, retrieved = await lookup_cached_answer(req.question, key, scoped=req.files is not None)
+            if cached:
+                yield f"event: context\ndata: {json.dumps(cached['context'])}\n\n"
+                yield f"event: token\ndata: {json.dumps(cached['answer'])}\n\n"
+                yield f"event: reasoning\ndata: {json.dumps(cached['reasoning'])}\n\n"
+                yield f"event: done\ndata: {json.dumps({**cached, 'cached': True})}\n\n"
+                return
+
+            async for event, data in ragas_generate_stream(req.question, key=key, q_embed=q_embed, files=req.files,
+                                                          retrieved=retrieved):
+                if event == "done":
+                    if data["relevant"] and q_embed is not None and req.files is None:
+                        semantic_cache.add(q_embed, req.question, wants_summary(req.question))
+                    # Save final response in cache so /metrics can be polled as usual
+                    answers_cache.set(key, {
+                        "answer": data["answer"],
+                        "context": data["context"],
+                        "relevant": data["relevant"],
+                        "metrics": None,
+                        "reasoning": data["reasoning"]
+                    }, tags=data["sources"])
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 
 # -----------------------------
 # Metrics endpoint (DeepEval)
 # -----------------------------
 @app.post("/metrics")
 async def metrics(req: Question):
-    cached = answers_cache.get(req.question)
+    cached = answers_cache.get(cache_key(req.question, await asyncio.to_thread(get_corpus_version), req.files))
     if not cached:
         return {"error": "No answer found for this question. Ask first."}
 
@@ -124,6 +344,27 @@ async def metrics(req: Question):
         "reasoning": reasoning
     }
 
+# -----------------------------
+# Evaluation scheduler statistics
+# -----------------------------
+@app.get("/eval_stats")
+async def eval_stats():
+    return {
+        "scheduler": eval_scheduler.stats(),
+        "deepeval_batches": deepeval_service.batcher.stats(),
+        "ragas_batches": ragas_batcher.stats(),
+    }
+
+# -----------------------------
+# Cache statistics
+# -----------------------------
+@app.get("/cache_stats")
+async def cache_stats():
+    stats = {"answers": answers_cache.stats(), "semantic": semantic_cache.stats()}
+    if rag_engine.embedding_cache:
+        stats["embeddings"] = rag_engine.embedding_cache.stats()
+    return stats
+
 # -----------------------------
 # Health check
 # -----------------------------
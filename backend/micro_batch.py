@@ -0,0 +1,71 @@
+"""
+Async micro-batching for evaluation calls.
+
+Callers await submit(item) one at a time; items arriving close together are
+handed to process_batch(items) as one list, flushed once max_size items are
+waiting or max_wait_ms after the first one arrived. process_batch is a
+blocking function returning one result per item, in order; it runs through
+the given `run` coroutine function (e.g. eval_scheduler.run_in_pool).
+"""
+
+import asyncio
+
+
+class MicroBatcher:
+    def __init__(self, process_batch, max_size: int, max_wait_ms: float, run=asyncio.to_thread, name: str = "batch"):
+        self.process_batch = process_batch
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait_ms / 1000
+        self.run = run
+        self.name = name
+        self._pending = []  # (item, future)
+        self._timer = None
+        self._tasks = set()  # running flushes, referenced so they are not garbage collected
+
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item):
+        """Queue one item and wait for its result."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending[:self.max_size], self._pending[self.max_size:]
+        if self._pending:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        if batch:
+            task = asyncio.create_task(self._process(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, batch):
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = await self.run(self.process_batch, [item for item, _ in batch])
+        except Exception as e:
+            print(f"[{self.name}] Batch of {len(batch)} failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():  # the waiting caller may have been cancelled
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+            "pending": len(self._pending),
+        }
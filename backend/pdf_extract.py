@@ -0,0 +1,90 @@
+"""
+PDF/TXT text extraction off the event loop.
+
+PDF pages are parsed in a ProcessPoolExecutor, several page ranges in
+parallel, and yielded in page order as soon as each range is done, so
+chunking and embedding can start on early pages while later ones are still
+being parsed. This module only imports PyPDF2, so pool workers stay cheap to
+start even with the "spawn" start method.
+"""
+
+import asyncio
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from PyPDF2 import PdfReader
+
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+PAGES_PER_TASK = int(os.getenv("EXTRACT_PAGES_PER_TASK", "8"))
+
+_pool = None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS)
+    return _pool
+
+
+# -----------------------------
+# Worker functions (run in the process pool)
+# -----------------------------
+def pdf_page_count(path: str) -> int:
+    return len(PdfReader(path).pages)
+
+
+def extract_pdf_pages(path: str, start: int, end: int) -> list[str]:
+    reader = PdfReader(path)
+    pages = []
+    for i in range(start, end):
+        try:
+            pages.append(reader.pages[i].extract_text() or "")
+        except Exception as e:
+            print(f"Error extracting page {i + 1} of {path}: {e}")
+            pages.append("")
+    return pages
+
+
+# -----------------------------
+# Async page stream
+# -----------------------------
+async def aiter_pages(filename: str, content: bytes, on_page_count=None):
+    """
+    Yield the text of each page of an uploaded PDF (or the whole text of a
+    TXT file) in order, without blocking the event loop.
+    on_page_count, if given, is called with the number of pages once it is known.
+    """
+    name = filename.lower()
+    if name.endswith(".txt"):
+        if on_page_count:
+            on_page_count(1)
+        yield content.decode("utf-8", errors="ignore")
+        return
+    if not name.endswith(".pdf"):
+        return
+
+    # Workers read the PDF from a temp file instead of receiving a pickled copy per page range
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        tmp.write(content)
+    loop = asyncio.get_running_loop()
+    pool = get_pool()
+    futures = []
+    try:
+        n_pages = await loop.run_in_executor(pool, pdf_page_count, tmp.name)
+        if on_page_count:
+            on_page_count(n_pages)
+        futures = [
+            loop.run_in_executor(pool, extract_pdf_pages, tmp.name, start, min(start + PAGES_PER_TASK, n_pages))
+            for start in range(0, n_pages, PAGES_PER_TASK)
+        ]
+        for future in futures:
+            for page in await future:
+                yield page
+    finally:
+        for future in futures:
+            future.cancel()
+        # Let still-running workers finish before deleting their input
+        await asyncio.gather(*futures, return_exceptions=True)
+        os.remove(tmp.name)
@@ -5,9 +5,32 @@
 - retrieved context is short per doc for frontend display
 - reasoning is summarized always
 - User-facing answer + extractive verification (advancement for rag_engine4.py)
+- Batched embedding requests (bounded by input count and tokens, per-batch retries)
+- ID-mapped FAISS index: removal drops only the affected chunk ids, no re-embedding
+- Index + chunks persisted to vectorstore/ and memory-mapped on startup
+- Pluggable FAISS backends (flat, IVF-Flat, IVF-PQ, HNSW) via index_factory
+- Async-native query path (aretrieve + agenerate_answer) on a shared AsyncOpenAI client;
+  index search, BM25, MMR and token counting run in worker threads, off the event loop
+- Persistent embedding cache keyed by (model, SHA-256 of text) for chunks and questions
+- Uploads parsed page by page in a process pool, embedding overlaps with parsing
+- Progress callbacks on the async ingestion path (used by ingest_jobs)
+- Copy-on-write corpus snapshots: lock-free reads, writers swap in new state atomically
+- Columnar chunk metadata (chunk_store): interned filenames, one UTF-8 text buffer, vectorized removal
+- Token streaming (astream_rag): context first, then answer tokens
+- mode="always" runs the full-answer and extractive-summary calls concurrently
+- Batch retrieval: many questions embedded in one request and searched as one matrix
+- Hybrid retrieval: BM25 inverted index (lexical_index) fused with vector hits by reciprocal rank fusion;
+  a confident lexical match skips the embedding call
+- Over-fetched candidates narrowed by vectorized MMR with a per-file cap, so prompts carry fewer near-duplicate chunks
+- File-scoped search (files=[...]): exact search over just those files' vectors, or a FAISS ID selector for large scopes
+- Token-budgeted prompt context: adjacent chunks merged without their overlap, filled in relevance order
+- Streaming, sentence-aware chunking sized in tokens (chunker); chunks keep (page, start, end) source offsets
+- Segmented corpus (segments): an add appends one segment, a removal records tombstones, and
+  segments are merged and compacted in the background, so writes cost O(chunks touched)
+- Worker processes sharing one vectorstore/ pick up each other's writes (under the store lock, or every STORE_SYNC_INTERVAL for reads)
 """
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
 import numpy as np
 import faiss
 from dotenv import load_dotenv
@@ -15,14 +38,203 @@ import os
 from PyPDF2 import PdfReader
 import io
 import textwrap
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+from vector_store import VectorStore, REMOVED_RECORD
+from chunk_store import ChunkStore
+import segments
+from segments import SegmentSet, make_segment
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from chunker import StreamingChunker, iter_chunks, count_tokens, get_encoding
+import pdf_extract
+from embedding_cache import EmbeddingCache
+import index_factory
 
 load_dotenv()
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+# Shared async client: one instance per process so every request reuses its
+# pooled keep-alive connections instead of opening new ones.
+async_client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    timeout=float(os.getenv("OPENAI_TIMEOUT", "60")),
+)
+
+# --- Embedding settings ---
+EMBED_MODEL = "text-embedding-3-small"
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))        # max inputs per request (API limit: 2048)
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "100000"))  # max tokens per request (API limit: 300k)
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "3"))
+EMBED_RETRY_DELAY = float(os.getenv("EMBED_RETRY_DELAY", "1"))      # seconds before the first retry, doubled after each
+# Transient failures worth retrying; anything else (bad request, auth, quota...) fails at once
+EMBED_RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+# --- On-disk vector store (set VECTORSTORE_DIR="" to keep everything in memory only) ---
+VECTORSTORE_DIR = os.getenv(
+    "VECTORSTORE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "vectorstore")
+)
+store = VectorStore(VECTORSTORE_DIR) if VECTORSTORE_DIR else None
+STORE_SYNC_INTERVAL = float(os.getenv("STORE_SYNC_INTERVAL", "1"))  # seconds between checks for other workers' writes
+
+# --- Content-addressed embedding cache (set EMBEDDING_CACHE_PATH="" to disable) ---
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "vectorstore", "embedding_cache.sqlite"),
+)
+if EMBEDDING_CACHE_PATH:
+    os.makedirs(os.path.dirname(EMBEDDING_CACHE_PATH) or ".", exist_ok=True)
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH) if EMBEDDING_CACHE_PATH else None
+
 # --- In-memory storage ---
-documents = []  # now store as dict: {"filename": str, "chunk": str}
-embeddings = None
-index = None
+class CorpusSnapshot(NamedTuple):
+    """
+    One consistent, never-mutated view of the indexed corpus. Writers build a
+    new snapshot off to the side and publish it with a single assignment, so a
+    reader that grabs current_snapshot() once can search without any lock.
+    """
+    segments: SegmentSet = SegmentSet()  # chunk ids, vectors, chunk metadata and FAISS indexes (see segments)
+    lexical: LexicalIndex = LexicalIndex()  # BM25 postings keyed by chunk id
+    next_chunk_id: int = 0
+    version: int = 0  # bumped on every add/remove; part of answer cache keys
+
+
+_snapshot = CorpusSnapshot()
+_write_lock = threading.Lock()  # one writer at a time; readers never take it
+_last_sync = 0.0  # time.monotonic() of the last check for other workers' writes
+
+
+def current_snapshot() -> CorpusSnapshot:
+    _refresh()
+    return _snapshot
+
+
+def _publish(snapshot: CorpusSnapshot):
+    """Swap in a new snapshot (call with _write_lock held). Readers holding the old one keep using it."""
+    global _snapshot
+    _snapshot = snapshot
+
+
+# -----------------------------
+# Corpus version
+# -----------------------------
+def get_corpus_version() -> int:
+    """Monotonic version of the indexed corpus, bumped on every add and remove."""
+    return current_snapshot().version
+
+
+def store_meta(snapshot: CorpusSnapshot) -> dict:
+    return {"next_chunk_id": snapshot.next_chunk_id, "corpus_version": snapshot.version}
+
+
+# -----------------------------
+# Load persisted index + chunks
+# -----------------------------
+def load_vectorstore() -> int:
+    """
+    Restore the segments from the on-disk store. Vectors (and trained indexes)
+    are memory-mapped read-only and searched in place; a missing or stale index
+    is rebuilt by the background merge. Returns the number of chunks loaded.
+    """
+    if not store:
+        return 0
+    with _write_lock:
+        snapshot = _loaded_snapshot()
+        if snapshot is None:
+            return 0
+        _publish(snapshot)
+    schedule_merge()
+
+    print(f"[VectorStore] Loaded {snapshot.segments.count} chunks from {store.path}")
+    return snapshot.segments.count
+
+
+def _loaded_snapshot():
+    """A snapshot of everything in the store (None if it is empty)."""
+    state = store.load()
+    if state is None:
+        return None
+    loaded, deleted, meta = state
+    segment_set = SegmentSet.from_segments(loaded, deleted)
+    # The BM25 index is not persisted; it is rebuilt off the startup path (no API calls),
+    # and until then hybrid retrieval uses the vector hits alone
+    lexical = LexicalIndex.build_in_background(segment_set.live_chunks)
+    return CorpusSnapshot(segment_set, lexical, meta["next_chunk_id"], meta.get("corpus_version", 0))
+
+
+# -----------------------------
+# Other workers' writes
+# -----------------------------
+def _apply_store_changes(changes):
+    """
+    Publish what other processes wrote to the store (vector_store.StoreChanges).
+    Call with _write_lock and the store lock held.
+    """
+    if changes is None:
+        return
+    if changes.reload:
+        # Another process compacted the store: its rows moved, so map everything again
+        _publish(_loaded_snapshot() or CorpusSnapshot())
+        schedule_merge()
+        return
+
+    old = _snapshot
+    segment_set, lexical = old.segments, old.lexical
+    first, end = changes.rows
+    if end > first:
+        vectors, ids = store.map_rows(first, end)
+        records = [changes.documents.get(chunk_id, REMOVED_RECORD) for chunk_id in ids.tolist()]
+        segment_set = segment_set.append(make_segment(ids, vectors, ChunkStore.from_records(records),
+                                                      store_rows=(first, end)))
+        added = [chunk_id for chunk_id in ids.tolist() if chunk_id in changes.documents]
+        lexical = lexical.add(np.array(added, dtype="int64"), [changes.documents[i]["chunk"] for i in added])
+        # Chunks that were added and removed again since the last sync
+        segment_set = segment_set.remove_ids(ids[~np.isin(ids, added)])[0]
+    if len(changes.removed):
+        segment_set, removed_ids, removed_texts = segment_set.remove_ids(changes.removed)
+        lexical = lexical.remove(removed_ids, removed_texts)
+    _publish(CorpusSnapshot(
+        segment_set, lexical,
+        max(old.next_chunk_id, changes.meta.get("next_chunk_id", 0)),
+        max(old.version, changes.meta.get("corpus_version", 0)),
+    ))
+    schedule_merge()
+
+
+@contextmanager
+def _store_synced():
+    """
+    Hold the store lock with every other worker's writes applied; yields the current snapshot.
+    Use inside _write_lock around a write, so the chunk ids and version it assigns continue theirs.
+    """
+    if not store:
+        yield _snapshot
+        return
+    with store.locked():
+        _apply_store_changes(store.read_changes(repair=True))
+        yield _snapshot
+
+
+def _refresh():
+    """
+    Pick up other workers' writes for readers, at most once per STORE_SYNC_INTERVAL and only
+    if meta.json changed. Skipped (never waited for) while a write or the BM25 build is in progress.
+    """
+    global _last_sync
+    if not store or time.monotonic() - _last_sync < STORE_SYNC_INTERVAL:
+        return
+    _last_sync = time.monotonic()
+    if not store.changed() or not _snapshot.lexical.ready() or not _write_lock.acquire(blocking=False):
+        return
+    try:
+        with store.locked(shared=True, blocking=False) as acquired:
+            if acquired:
+                _apply_store_changes(store.read_changes())
+    finally:
+        _write_lock.release()
 
 
 # -----------------------------
@@ -43,14 +255,74 @@ def extract_text_from_file(filename: str, content: bytes) -> str:
 # -----------------------------
 # Helper: Chunk large text
 # -----------------------------
-def chunk_text(text: str, chunk_size: int = 800, overlap: int = 100):
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = min(start + chunk_size, len(text))
-        chunks.append(text[start:end])
-        start += chunk_size - overlap
-    return [c.strip() for c in chunks if c.strip()]
+def chunk_text(text: str) -> list[str]:
+    """Sentence-aware, token-sized chunks of one document (see chunker)."""
+    return [chunk.text for chunk in iter_chunks([text])]
+
+# -----------------------------
+# Helper: Batched embeddings
+# -----------------------------
+def batch_ranges(texts: list[str], max_inputs: int = None, max_tokens: int = None):
+    """
+    Split texts into consecutive (start, end) ranges bounded by both the number
+    of inputs and the total token count per request.
+    """
+    max_inputs = max_inputs or EMBED_BATCH_SIZE
+    max_tokens = max_tokens or EMBED_BATCH_TOKENS
+
+    start, batch_tokens = 0, 0
+    for i, text in enumerate(texts):
+        tokens = count_tokens(text)
+        if i > start and (i - start >= max_inputs or batch_tokens + tokens > max_tokens):
+            yield start, i
+            start, batch_tokens = i, 0
+        batch_tokens += tokens
+    if start < len(texts):
+        yield start, len(texts)
+
+
+def embed_batch(batch: list[str]) -> list[list[float]]:
+    """
+    Embed one batch, retrying only this batch on transient failures (EMBED_RETRYABLE_ERRORS).
+    The client's own retries are turned off here so a failure costs at most EMBED_MAX_RETRIES + 1 requests.
+    """
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        try:
+            response = client.with_options(max_retries=0).embeddings.create(model=EMBED_MODEL, input=batch)
+            # The API returns one item per input; order by index to be safe
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except EMBED_RETRYABLE_ERRORS as e:
+            if attempt == EMBED_MAX_RETRIES:
+                raise
+            delay = EMBED_RETRY_DELAY * 2 ** attempt
+            print(f"[Embeddings] Batch of {len(batch)} failed ({e}), retrying in {delay}s")
+            time.sleep(delay)
+
+
+def embed_texts(texts: list[str]) -> np.ndarray:
+    """
+    Embed texts in size-bounded batches.
+    Texts already in the embedding cache (and duplicates within texts) are not sent again;
+    every embedded batch is cached right away, so a failed upload resumes where it stopped.
+    Returns a float32 array with one row per input, in input order.
+    """
+    cached = embedding_cache.get_many(EMBED_MODEL, texts) if embedding_cache else [None] * len(texts)
+    missing = list(dict.fromkeys(t for t, v in zip(texts, cached) if v is None))
+
+    new_vectors = {}
+    for start, end in batch_ranges(missing):
+        batch = missing[start:end]
+        vectors = embed_batch(batch)
+        if embedding_cache:
+            embedding_cache.put_many(EMBED_MODEL, batch, vectors)
+        new_vectors.update(zip(batch, vectors))
+
+    return np.array([v if v is not None else new_vectors[t] for t, v in zip(texts, cached)]).astype("float32")
+
+
+def embed_query(question: str) -> np.ndarray:
+    """Embed one question (through the embedding cache); returns a (1, dim) float32 array."""
+    return embed_texts([question])
 
 # -----------------------------
 # Add documents to FAISS (with filename tracking)
@@ -60,104 +332,471 @@ def add_documents(docs: list[str], filenames: list[str] = None):
     docs: list of raw text or extracted text
     filenames: list of filenames corresponding to docs (optional)
     """
-    global documents, embeddings, index
-
-    expanded_docs = []
     doc_records = []
 
     for i, d in enumerate(docs):
-        chunks = chunk_text(d)
-        expanded_docs.extend(chunks)
+        # Track filenames (and source offsets) per chunk
+        fname = filenames[i] if filenames and i < len(filenames) else f"doc_{_snapshot.segments.count+i}"
+        doc_records.extend(chunk.record(fname) for chunk in iter_chunks([d]))
 
-        # Track filenames per chunk
-        fname = filenames[i] if filenames and i < len(filenames) else f"doc_{len(documents)+i}"
-        for chunk in chunks:
-            doc_records.append({"filename": fname, "chunk": chunk})
+    if not doc_records:
+        return
 
-    documents.extend(doc_records)
+    # Generate embeddings for all new chunks (batched, rows follow doc_records order)
+    doc_embeds = embed_texts([doc["chunk"] for doc in doc_records])
+    index_chunks(doc_records, doc_embeds)
 
-    # Generate embeddings for all new chunks
-    doc_embeds = [
-        client.embeddings.create(model="text-embedding-3-small", input=doc["chunk"]).data[0].embedding
-        for doc in doc_records
-    ]
-    doc_embeds = np.array(doc_embeds).astype("float32")
 
-    if embeddings is None:
-        embeddings = doc_embeds
-        index = faiss.IndexFlatL2(len(doc_embeds[0]))
-        index.add(embeddings)
-    else:
-        index.add(doc_embeds)
+def index_chunks(doc_records: list[dict], doc_embeds: np.ndarray):
+    """
+    Add already embedded chunks to the index, chunk store and on-disk store.
+    They become one new segment, so the cost follows the new chunks, not the
+    corpus; the background merge folds segments together later.
+    """
+    with _write_lock, _store_synced() as old:
+        # Assign stable chunk ids so the index can later drop them selectively
+        new_ids = np.arange(old.next_chunk_id, old.next_chunk_id + len(doc_records), dtype="int64")
+        new = CorpusSnapshot(
+            old.segments,
+            old.lexical.add(new_ids, [doc["chunk"] for doc in doc_records]),
+            old.next_chunk_id + len(doc_records), old.version + 1,
+        )
+
+        # Copy on write: readers keep searching the old segments while the new one is added
+        embeddings, store_rows = np.ascontiguousarray(doc_embeds, dtype="float32"), None
+        if store:
+            store_rows = store.append(new_ids, doc_records, embeddings, store_meta(new))
+            embeddings = store.map_rows(*store_rows)[0]  # shared page cache instead of a private copy
+        segment = make_segment(new_ids, embeddings, ChunkStore.from_records(doc_records), store_rows=store_rows)
+        _publish(new._replace(segments=old.segments.append(segment)))
+    schedule_merge()
+
+# -----------------------------
+# Add an uploaded file with streamed extraction
+# -----------------------------
+INGEST_SEGMENT_CHARS = int(os.getenv("INGEST_SEGMENT_CHARS", "20000"))
+
+
+async def aadd_file(filename: str, content: bytes, progress=None) -> int:
+    """
+    Extract, chunk and embed one uploaded file as a pipeline: pages are parsed
+    in the process pool and chunked as they arrive, and every INGEST_SEGMENT_CHARS
+    of chunks is sent for embedding while later pages are still being parsed. The file's
+    chunks are added to the index together at the end.
+    progress, if given, is called as progress(event, value) (see aadd_pages).
+    Returns the number of chunks added (0 if no text could be extracted).
+    """
+    on_page_count = (lambda n: progress("pages", n)) if progress else None
+    return await aadd_pages(filename, pdf_extract.aiter_pages(filename, content, on_page_count), progress)
+
+
+async def aadd_text(name: str, text: str, progress=None) -> int:
+    """Same pipeline as aadd_file for raw text stored under the given name."""
+    async def single_page():
+        yield text
+
+    if progress:
+        progress("pages", 1)
+    return await aadd_pages(name, single_page(), progress)
+
+
+async def aadd_pages(filename: str, pages, progress=None) -> int:
+    """
+    Chunk and embed an async stream of page texts, then index the chunks in one step.
+    progress(event, value) receives "pages" (page count, once known), "page"
+    (one page parsed), "chunks" (n chunks created), "embedded" (n chunks
+    embedded), "indexed" (n chunks committed) and "error" (message).
+    """
+    report = progress or (lambda event, value: None)
+
+    async def embed_segment(chunks):
+        report("chunks", len(chunks))
+        vectors = await asyncio.to_thread(embed_texts, [chunk.text for chunk in chunks])
+        report("embedded", len(chunks))
+        return chunks, vectors
+
+    embed_tasks = []
+    chunker = StreamingChunker()
+    segment, segment_chars = [], 0  # chunks not yet sent for embedding
+    try:
+        async for page in pages:
+            report("page", 1)
+            for chunk in chunker.feed(page):
+                segment.append(chunk)
+                segment_chars += len(chunk.text)
+            if segment_chars >= INGEST_SEGMENT_CHARS:
+                embed_tasks.append(asyncio.create_task(embed_segment(segment)))
+                segment, segment_chars = [], 0
+
+        segment.extend(chunker.close())
+        if segment:
+            embed_tasks.append(asyncio.create_task(embed_segment(segment)))
+        segments = await asyncio.gather(*embed_tasks)
+    except Exception as e:
+        for task in embed_tasks:
+            task.cancel()
+        print(f"Error ingesting {filename}: {e}")
+        report("error", f"{filename}: {e}")
+        return 0
+
+    doc_records = [chunk.record(filename) for chunks, _ in segments for chunk in chunks]
+    if not doc_records:
+        return 0
+    # Committed as one snapshot swap: concurrent queries see the corpus either before or after this file
+    await asyncio.to_thread(index_chunks, doc_records, np.vstack([vectors for _, vectors in segments]))
+    report("indexed", len(doc_records))
+    return len(doc_records)
 
 # -----------------------------
 # Remove documents by filenames
 # -----------------------------
-def remove_documents(filenames: list[str]):
+def remove_documents(filenames: list[str], return_versions: bool = False):
     """
     Remove documents by their original filenames.
-    Returns list of removed filenames.
-    """
-    global documents, embeddings, index
-
-    filenames_set = set(filenames)
-    removed_files = set(doc["filename"] for doc in documents if doc["filename"] in filenames_set)
-
-    # Remove the documents
-    documents = [doc for doc in documents if doc["filename"] not in filenames_set]
-
-    # Rebuild FAISS index
-    if documents:
-        doc_embeds = [
-            client.embeddings.create(model="text-embedding-3-small", input=doc["chunk"]).data[0].embedding
-            for doc in documents
-        ]
-        doc_embeds = np.array(doc_embeds).astype("float32")
-        embeddings = doc_embeds
-        index = faiss.IndexFlatL2(len(doc_embeds[0]))
-        index.add(embeddings)
+    Their chunks are tombstoned (searches skip them until the background merge
+    drops them for good), so no embeddings are requested again and the cost
+    follows the removed chunks, not the corpus.
+    Returns list of removed filenames; with return_versions, returns
+    (removed filenames, replaced corpus version, new corpus version), both
+    versions read under the write lock so they are exactly the ones swapped.
+    """
+    with _write_lock, _store_synced() as old:
+        removed_files = [f for f in dict.fromkeys(filenames) if old.segments.has_file(f)]
+        if not removed_files:
+            return ([], old.version, old.version) if return_versions else []
+
+        segment_set, removed_ids, removed_texts = old.segments.remove_files(removed_files)
+        new = CorpusSnapshot(
+            segment_set, old.lexical.remove(removed_ids, removed_texts), old.next_chunk_id, old.version + 1,
+        )
+        if store:
+            store.remove(removed_ids, store_meta(new))
+        _publish(new)
+    schedule_merge()
+
+    if return_versions:
+        return removed_files, old.version, new.version
+    return removed_files
+
+# -----------------------------
+# Background segment merges
+# -----------------------------
+_merge_lock = threading.Lock()  # one merge (or rebuild_index) at a time
+_merge_wanted = threading.Event()
+_merger = None  # daemon thread, started by the first write
+_merger_start_lock = threading.Lock()
+_index_kind = None  # backend chosen by rebuild_index(kind); FAISS_INDEX_TYPE otherwise
+
+
+def schedule_merge():
+    """Wake the background merger, which runs segments.plan_merge until it has nothing left to do."""
+    global _merger
+    with _merger_start_lock:
+        if _merger is None:
+            _merger = threading.Thread(target=_merge_loop, name="segment-merge", daemon=True)
+            _merger.start()
+    _merge_wanted.set()
+
+
+def _merge_loop():
+    while True:
+        _merge_wanted.wait()
+        _merge_wanted.clear()
+        try:
+            while merge_step():
+                pass
+        except Exception as e:
+            print(f"[Segments] Background merge failed: {e}")
+
+
+def merge_step(kind: str = None, compact: bool = False) -> bool:
+    """Run the next planned merge (or, with compact, a full compaction); returns whether one ran."""
+    kind = kind or _index_kind or index_factory.INDEX_TYPE
+    with _merge_lock:
+        with _write_lock:
+            snapshot = _snapshot
+            position = store.position() if store else None
+        plan = ("compact", None) if compact else segments.plan_merge(snapshot.segments, kind)
+        if plan is None:
+            return False
+        if plan[0] == "compact":
+            _compact(snapshot, position, kind, retrain=compact)
+        else:
+            _merge(snapshot, *plan[1])
+        return True
+
+
+def _unchanged(current: SegmentSet, merged: SegmentSet, first: int, end: int) -> bool:
+    """True if current still holds merged.segments[first:end] at the same positions."""
+    return len(current.segments) >= end and all(
+        a is b for a, b in zip(current.segments[first:end], merged.segments[first:end])
+    )
+
+
+def _merge(snapshot: CorpusSnapshot, first: int, end: int):
+    """Combine segments[first:end] (no FAISS index, adjacent in the store) into one segment."""
+    parts = snapshot.segments.segments[first:end]
+    embeddings = store_rows = None
+    if store and all(part.store_rows for part in parts):
+        store_rows = (parts[0].store_rows[0], parts[-1].store_rows[1])
+        embeddings = store.map_rows(*store_rows)[0]
+    merged = segments.concat_segments(parts, embeddings, store_rows)
+
+    with _write_lock:
+        current = _snapshot
+        if _unchanged(current.segments, snapshot.segments, first, end):
+            _publish(current._replace(segments=current.segments.replace(first, end, (merged,))))
+
+
+def _compacted_blocks(segment_set: SegmentSet):
+    """(ids, vectors, records) of the live rows of every segment, in bounded blocks."""
+    for position, segment in enumerate(segment_set.segments):
+        live = np.flatnonzero(segment_set.live_mask(position))
+        for start in range(0, len(live), segments.EXACT_BLOCK_ROWS):
+            rows = live[start:start + segments.EXACT_BLOCK_ROWS]
+            yield segment.chunk_ids[rows], np.asarray(segment.embeddings[rows]), segment.chunks.records(rows.tolist())
+
+
+def _compact(snapshot: CorpusSnapshot, position: tuple, kind: str, retrain: bool = False):
+    """
+    Rewrite the snapshot's segments into one base segment without tombstones,
+    with a FAISS index of the given kind when there are enough chunks to train
+    it (exact search otherwise). Writes that land meanwhile stay as segments behind it.
+    The old base's IVF training is reused until the corpus has doubled, unless retrain.
+    """
+    segment_set = snapshot.segments
+    old_base = segment_set.segments[0].index if segment_set.segments else None
+    chunks = ChunkStore.concat([
+        segment.chunks.take(segment_set.live_mask(position))
+        for position, segment in enumerate(segment_set.segments)
+    ])
+    if store:
+        rows, (vectors, ids) = store.write_compacted(_compacted_blocks(segment_set))
     else:
-        embeddings = None
-        index = None
+        blocks = list(_compacted_blocks(segment_set))
+        ids = np.concatenate([block[0] for block in blocks]) if blocks else np.empty(0, dtype="int64")
+        vectors = np.concatenate([block[1] for block in blocks]) if blocks else None
+        rows = len(ids)
+
+    index = None
+    if rows and kind != "flat" and rows >= index_factory.min_training_points(kind):
+        trained = old_base if old_base is not None and not retrain and rows <= 2 * old_base.ntotal else None
+        index = index_factory.build_index(vectors, ids, kind, trained=trained)
+    base = (make_segment(ids, vectors, chunks, index, (0, rows) if store else None),) if rows else ()
+
+    with _write_lock, _store_synced() as current:
+        if not _unchanged(current.segments, segment_set, 0, len(segment_set.segments)):
+            if store:
+                store.discard_compaction()
+            return
+        tail = current.segments.segments[len(segment_set.segments):]
+        if store:
+            shift = store.finish_compaction(rows, position, index, store_meta(current))
+            tail = tuple(_moved(segment, shift) for segment in tail)
+        _publish(current._replace(segments=SegmentSet(
+            base + tail, np.setdiff1d(current.segments.deleted, segment_set.deleted), current.segments.file_ranges,
+        )))
+    print(f"[Segments] Compacted {segment_set.rows} rows into {rows} ({index_factory.index_kind(index) if index else 'exact'})")
+
 
-    return list(removed_files)
+def _moved(segment: segments.Segment, shift: int) -> segments.Segment:
+    """segment re-mapped after a compaction moved its store rows down by shift."""
+    first, end = segment.store_rows[0] - shift, segment.store_rows[1] - shift
+    vectors, ids = store.map_rows(first, end)
+    return segment._replace(embeddings=vectors, chunk_ids=ids, store_rows=(first, end))
 
 # -----------------------------
-# Query RAG
+# Rebuild index from stored vectors
 # -----------------------------
-def query_rag(question: str, k: int = 3, mode: str = "auto"):
+def rebuild_index(kind: str = None):
     """
-    Retrieve relevant chunks from FAISS, generate full or summarized answers using GPT-3.5-turbo,
-    and handle extractive summary requests for accurate metrics.
+    Compact the corpus and retrain and rebuild its index from the stored embeddings
+    (no API calls), e.g. after switching FAISS_INDEX_TYPE or once an IVF corpus has
+    grown well past its training set. Later background merges keep the chosen kind.
+    Returns the backend now in use ("flat" for exact search), or None if the corpus is empty.
+    """
+    global _index_kind
+    _index_kind = kind or _index_kind
+    merge_step(kind, compact=True)
+    snapshot = current_snapshot()
+    if not snapshot.segments.count:
+        return None
+    base = snapshot.segments.segments[0]
+    return index_factory.index_kind(base.index) if base.index is not None else "flat"
 
-    Modes:
-    - "auto": Normal behavior. Generates a summary only if the question asks for it.
-    - "always": Evaluation mode. Generates both a full answer and an extractive summary for metrics.
+# -----------------------------
+# Query helpers (shared by the sync and async paths)
+# -----------------------------
+SUMMARY_TRIGGERS = ["summarize", "in short", "concise", "briefly", "summary"]
+CHAT_MODEL = "gpt-3.5-turbo"
 
-    Returns:
-    - answer_to_show: Full or summarized answer, for display.
-    - retrieved_context: List of concise context snippets for frontend display.
-    - success: True if relevant context found, False otherwise.
-    - answer_summary (only in 'always' mode): Separate summary for metric evaluation (extractive).
+
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")              # "vector", "lexical" or "hybrid"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))       # hits per retriever before fusion
+LEXICAL_FAST_PATH = os.getenv("LEXICAL_FAST_PATH", "1") == "1"      # skip embedding on a confident BM25 match
+LEXICAL_FAST_PATH_MIN_SCORE = float(os.getenv("LEXICAL_FAST_PATH_MIN_SCORE", "0.6"))  # BM25 score / query_weight
+LEXICAL_FAST_PATH_MARGIN = float(os.getenv("LEXICAL_FAST_PATH_MARGIN", "2"))  # top score vs runner-up
+
+RETRIEVAL_OVERFETCH = int(os.getenv("RETRIEVAL_OVERFETCH", "4"))    # candidates fetched per returned chunk
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))                  # 1 = relevance only, 0 = diversity only
+MAX_CHUNKS_PER_FILE = int(os.getenv("MAX_CHUNKS_PER_FILE", "2"))    # 0 = no per-file cap
+SCOPED_EXACT_MAX_CHUNKS = int(os.getenv("SCOPED_EXACT_MAX_CHUNKS", "20000"))  # larger scopes use an ID selector
+
+
+def file_scope(files, snapshot: CorpusSnapshot):
+    """The chunks of a files=[...] filter as a segments.Scope (None means the whole corpus)."""
+    return snapshot.segments.scope(files) if files is not None else None
+
+
+def vector_rows(q_embeds: np.ndarray, k: int, snapshot: CorpusSnapshot, scope: segments.Scope = None):
     """
-    global index, documents
-    if not documents:
-        return "", [], False
+    Search all query rows at once; returns best-first chunk rows per query (within scope, if given).
+    A scope is searched exactly on just its vectors, or through a FAISS ID selector
+    where it leaves more than SCOPED_EXACT_MAX_CHUNKS chunks of an indexed segment.
+    """
+    return snapshot.segments.search(q_embeds, k, scope, SCOPED_EXACT_MAX_CHUNKS)
 
-    # Step 1: Embed question and search FAISS
-    q_embed = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=question
-    ).data[0].embedding
-    q_embed = np.array([q_embed]).astype("float32")
-    D, I = index.search(q_embed, k)
-    retrieved = [documents[i] for i in I[0]]
 
-    # Step 2: Prepare concise context snippets for frontend
-    def summarize_chunk(chunk, max_sentences=2):
-        sentences = chunk.split(". ")
-        return ". ".join(sentences[:max_sentences]) + ("" if len(sentences) <= max_sentences else "...")
+def lexical_rows(question: str, k: int, snapshot: CorpusSnapshot, scope: segments.Scope = None):
+    """BM25 top-k as (chunk rows, scores), best first (within scope, if given)."""
+    ids, scores = snapshot.lexical.search(question, k, scope.id_ranges if scope is not None else None)
+    return snapshot.segments.rows_of(ids), scores
+
+
+def lexical_fast_path(question: str, k: int, snapshot: CorpusSnapshot = None, files=None):
+    """
+    Chunk rows for a question that BM25 alone answers confidently (a clear
+    winner, e.g. an exact ID or error code), so no embedding is needed; None otherwise.
+    The top score is normalized by the question's LexicalIndex.query_weight, so one
+    threshold holds for short and long questions and for any corpus size.
+    In RETRIEVAL_MODE="lexical" every question takes this path.
+    """
+    snapshot = snapshot or current_snapshot()
+    scope = file_scope(files, snapshot)
+    if RETRIEVAL_MODE == "lexical":
+        rows = lexical_rows(question, k * RETRIEVAL_OVERFETCH, snapshot, scope)[0]
+        return diversify(rows, None, k, snapshot)
+    if RETRIEVAL_MODE != "hybrid" or not LEXICAL_FAST_PATH:
+        return None
+    rows, scores = lexical_rows(question, max(k * RETRIEVAL_OVERFETCH, 2), snapshot, scope)
+    weight = snapshot.lexical.query_weight(question)  # 0 for a question of stopwords only
+    if not len(rows) or not weight or scores[0] < LEXICAL_FAST_PATH_MIN_SCORE * weight:
+        return None
+    if len(rows) > 1 and scores[0] < LEXICAL_FAST_PATH_MARGIN * scores[1]:
+        return None
+    return diversify(rows, None, k, snapshot)
+
+
+def lexical_fast_path_records(question: str, k: int, snapshot: CorpusSnapshot = None, files=None):
+    """lexical_fast_path as chunk records (None if the question needs the vector search)."""
+    snapshot = snapshot or current_snapshot()
+    rows = lexical_fast_path(question, k, snapshot, files)
+    return retrieved_records(snapshot, rows) if rows is not None else None
+
+
+def diversify(rows: np.ndarray, q_embed: np.ndarray, k: int, snapshot: CorpusSnapshot) -> np.ndarray:
+    """
+    Pick k of the best-first candidate rows by maximal marginal relevance on
+    the stored chunk vectors, taking at most MAX_CHUNKS_PER_FILE per file
+    (relaxed if that leaves fewer than k). Relevance is cosine similarity to
+    q_embed, or the candidates' rank when q_embed is None (fused/BM25 order).
+    """
+    if len(rows) <= 1:
+        return rows[:k]
+
+    vectors = snapshot.segments.vectors(rows)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    if q_embed is not None:
+        query = q_embed.reshape(-1) / (np.linalg.norm(q_embed) + 1e-12)
+        relevance = vectors @ query
+    else:
+        relevance = 1.0 - np.arange(len(rows), dtype="float32") / len(rows)
+    similarity = vectors @ vectors.T  # candidate x candidate cosine
+
+    file_ids = snapshot.segments.file_codes(rows)
+    per_file = np.zeros(file_ids.max() + 1, dtype="int32")
+    max_similarity = np.full(len(rows), -np.inf, dtype="float32")  # to anything already selected
+    available = np.ones(len(rows), dtype=bool)
+    selected = []
+    for _ in range(min(k, len(rows))):
+        redundancy = np.where(np.isfinite(max_similarity), max_similarity, 0.0)
+        score = MMR_LAMBDA * relevance - (1 - MMR_LAMBDA) * redundancy
+        allowed = available
+        if MAX_CHUNKS_PER_FILE > 0:
+            capped = available & (per_file[file_ids] < MAX_CHUNKS_PER_FILE)
+            if capped.any():
+                allowed = capped
+        pick = int(np.argmax(np.where(allowed, score, -np.inf)))
+        selected.append(pick)
+        available[pick] = False
+        per_file[file_ids[pick]] += 1
+        np.maximum(max_similarity, similarity[pick], out=max_similarity)
+    return rows[selected]
+
+
+def candidate_rows(questions, q_embeds: np.ndarray, k: int, snapshot: CorpusSnapshot, scope: segments.Scope = None):
+    """Best-first candidate chunk rows per question for the configured RETRIEVAL_MODE."""
+    if RETRIEVAL_MODE == "lexical":
+        return [lexical_rows(q, k, snapshot, scope)[0] for q in questions]
+    if RETRIEVAL_MODE != "hybrid" or questions is None:
+        return vector_rows(q_embeds, k, snapshot, scope)
+
+    candidates = max(k, HYBRID_CANDIDATES)
+    return [
+        reciprocal_rank_fusion([dense, lexical_rows(q, candidates, snapshot, scope)[0]], k)
+        for q, dense in zip(questions, vector_rows(q_embeds, candidates, snapshot, scope))
+    ]
+
+
+def search_rows(questions, q_embeds: np.ndarray, k: int, snapshot: CorpusSnapshot, scope: segments.Scope = None):
+    """Over-fetch k * RETRIEVAL_OVERFETCH candidates per question, then keep a diverse top k."""
+    fetch = k * max(1, RETRIEVAL_OVERFETCH)
+    # Cosine relevance only where the candidates come from the vector index alone
+    by_vector = RETRIEVAL_MODE not in ("lexical", "hybrid") or questions is None
+    return [
+        diversify(rows, q_embeds[i] if by_vector else None, k, snapshot)
+        for i, rows in enumerate(candidate_rows(questions, q_embeds, fetch, snapshot, scope))
+    ]
+
+
+def retrieved_records(snapshot: CorpusSnapshot, rows: np.ndarray) -> list[dict]:
+    """Chunk records for rows (best first), tagged with their chunk_id so build_context can merge neighbours."""
+    records = snapshot.segments.records(rows)
+    for record, chunk_id in zip(records, snapshot.segments.ids(rows).tolist()):
+        record["chunk_id"] = chunk_id
+    return records
+
+
+def search_index(q_embed: np.ndarray, k: int, snapshot: CorpusSnapshot = None, question: str = None, files=None):
+    """
+    Search and return the retrieved chunk records, all from one snapshot
+    (hybrid if question is given, limited to files if given).
+    """
+    return search_index_batch(q_embed, k, snapshot, [question] if question is not None else None, files)[0]
+
+
+def search_index_batch(q_embeds: np.ndarray, k: int, snapshot: CorpusSnapshot = None, questions=None, files=None):
+    """Search all queries at once (one FAISS call); returns one list of chunk records per query."""
+    snapshot = snapshot or current_snapshot()
+    scope = file_scope(files, snapshot)
+    return [
+        retrieved_records(snapshot, rows)
+        for rows in search_rows(questions, q_embeds, k, snapshot, scope)
+    ]
+
 
+def summarize_chunk(chunk, max_sentences=2):
+    sentences = chunk.split(". ")
+    return ". ".join(sentences[:max_sentences]) + ("" if len(sentences) <= max_sentences else "...")
+
+
+def source_files(retrieved):
+    """Filenames the retrieved chunks came from (used to invalidate cached answers)."""
+    return sorted({doc["filename"] for doc in retrieved})
+
+
+def context_snippets(retrieved):
+    """Concise context snippets for frontend display, one per file."""
     seen_files = set()
     retrieved_context = []
     for doc in retrieved:
@@ -165,18 +804,84 @@ def query_rag(question: str, k: int = 3, mode: str = "auto"):
             short_chunk = summarize_chunk(doc["chunk"])
             retrieved_context.append(f"[{doc['filename']}] {short_chunk}")
             seen_files.add(doc["filename"])
+    return retrieved_context
 
-    if not retrieved_context:
-        return "", retrieved_context, False
 
-    # Step 3: Combine full retrieved context
-    context_text = " ".join([doc["chunk"] for doc in retrieved])
+def wants_summary(question: str) -> bool:
+    return any(word in question.lower() for word in SUMMARY_TRIGGERS)
+
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))  # max context tokens per prompt
+CHUNK_OVERLAP = 100  # character overlap of chunks stored without offsets (older vector stores)
+MIN_MERGE_OVERLAP = 20  # shorter suffix/prefix matches are treated as coincidence
+
 
-    # Step 4: Detect summary requests
-    summary_triggers = ["summarize", "in short", "concise", "briefly", "summary"]
-    is_summary_request = any(word in question.lower() for word in summary_triggers)
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    encoding = get_encoding()
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    return text[:max_tokens * 4]
+
+
+def join_overlapping(left: str, right: str, left_end: int = -1, right_start: int = -1) -> str:
+    """
+    Join consecutive chunks, dropping the text right repeats from the end of left:
+    exactly by source offsets when both are known, else by matching up to 2 * CHUNK_OVERLAP chars.
+    """
+    if left_end >= 0 and right_start >= 0:
+        overlap = left_end - right_start
+        return left + right[overlap:] if 0 < overlap < len(right) else f"{left} {right}"
+    for size in range(min(2 * CHUNK_OVERLAP, len(left), len(right)), MIN_MERGE_OVERLAP - 1, -1):
+        if left.endswith(right[:size]):
+            return left + right[size:]
+    return f"{left} {right}"
+
+
+def build_context(retrieved, budget: int = None) -> str:
+    """
+    Prompt context from the retrieved chunks (best first). Consecutive chunks
+    of the same file are merged into one passage with their overlap removed,
+    and passages are added in order of their best chunk until `budget` tokens
+    (CONTEXT_TOKEN_BUDGET) are used; the passage that crosses it is truncated.
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+
+    # Passages: [best rank, filename, last chunk_id, end offset of the last chunk, text]
+    passages = []
+    ranked = sorted(enumerate(retrieved), key=lambda item: (item[1]["filename"], item[1].get("chunk_id", -1)))
+    for rank, doc in ranked:
+        chunk_id = doc.get("chunk_id")
+        last = passages[-1] if passages else None
+        if last and chunk_id is not None and last[1] == doc["filename"] and last[2] is not None:
+            if chunk_id == last[2]:
+                continue  # same chunk retrieved twice
+            if chunk_id == last[2] + 1:
+                last[0] = min(last[0], rank)
+                last[4] = join_overlapping(last[4], doc["chunk"], last[3], doc.get("start", -1))
+                last[2], last[3] = chunk_id, doc.get("end", -1)
+                continue
+        passages.append([rank, doc["filename"], chunk_id, doc.get("end", -1), doc["chunk"]])
+
+    parts, used = [], 0
+    for *_, text in sorted(passages, key=lambda passage: passage[0]):
+        tokens = count_tokens(text)
+        if used + tokens > budget:
+            if budget - used > 0:
+                parts.append(truncate_tokens(text, budget - used))
+            break
+        parts.append(text)
+        used += tokens
+    return "\n\n".join(parts)
+
+
+def build_prompts(question: str, retrieved):
+    """Returns (normal_prompt, summary_prompt, is_summary_request)."""
+    # Merge, dedupe and budget the retrieved context
+    context_text = build_context(retrieved)
+
+    # Detect summary requests
+    is_summary_request = wants_summary(question)
 
-    # Step 5: Construct prompts
     normal_prompt = f"""
     Answer the question in 4-5 sentences based on the context below.
 
@@ -201,47 +906,219 @@ def query_rag(question: str, k: int = 3, mode: str = "auto"):
     Strict Extractive Summary:
     """
 
-    # Step 6: Generate answers
-    if mode == "always":
-        full_response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": normal_prompt}]
-        ).choices[0].message.content
+    return normal_prompt, summary_prompt, is_summary_request
+
+
+def verify_answer(full_answer, extractive_summary):
+    verified_sentences = []
+    for sentence in full_answer.split('. '):
+        sentence_clean = sentence.strip()
+        if not sentence_clean:
+            continue
+        # Check if sentence or parts appear in extractive summary
+        if sentence_clean in extractive_summary or any(fragment in extractive_summary for fragment in sentence_clean.split(', ')):
+            verified_sentences.append(sentence_clean)
+        else:
+            verified_sentences.append(f"[UNVERIFIED] {sentence_clean}")
+    return '. '.join(verified_sentences)
+
+# -----------------------------
+# Query RAG
+# -----------------------------
+def query_rag(question: str, k: int = 3, mode: str = "auto", files: list[str] = None):
+    """
+    Retrieve relevant chunks from FAISS, generate full or summarized answers using GPT-3.5-turbo,
+    and handle extractive summary requests for accurate metrics.
 
-        summary_response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": summary_prompt}]
+    Modes:
+    - "auto": Normal behavior. Generates a summary only if the question asks for it.
+    - "always": Evaluation mode. Generates both a full answer and an extractive summary for metrics.
+
+    files: only search the chunks of these uploaded files (None searches everything).
+
+    Returns:
+    - answer_to_show: Full or summarized answer, for display.
+    - retrieved_context: List of concise context snippets for frontend display.
+    - success: True if relevant context found, False otherwise.
+    - answer_summary (only in 'always' mode): Separate summary for metric evaluation (extractive).
+    """
+    snapshot = current_snapshot()
+    if not snapshot.segments.count:
+        return "", [], False
+
+    # Step 1: Embed question and search (unless BM25 alone is confident)
+    retrieved = lexical_fast_path_records(question, k, snapshot, files)
+    if retrieved is None:
+        retrieved = search_index(embed_query(question), k, snapshot, question, files)
+
+    # Step 2: Prepare concise context snippets for frontend
+    retrieved_context = context_snippets(retrieved)
+    if not retrieved_context:
+        return "", retrieved_context, False
+
+    # Step 3: Construct prompts
+    normal_prompt, summary_prompt, is_summary_request = build_prompts(question, retrieved)
+
+    def generate(prompt):
+        return client.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=[{"role": "user", "content": prompt}]
         ).choices[0].message.content
 
-        # Step 7: Optional verification
-        def verify_answer(full_answer, extractive_summary):
-            verified_sentences = []
-            for sentence in full_answer.split('. '):
-                sentence_clean = sentence.strip()
-                if not sentence_clean:
-                    continue
-                # Check if sentence or parts appear in extractive summary
-                if sentence_clean in extractive_summary or any(fragment in extractive_summary for fragment in sentence_clean.split(', ')):
-                    verified_sentences.append(sentence_clean)
-                else:
-                    verified_sentences.append(f"[UNVERIFIED] {sentence_clean}")
-            return '. '.join(verified_sentences)
+    # Step 4: Generate answers
+    if mode == "always":
+        # Both prompts only depend on the retrieved context, so run them concurrently
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            full_future = pool.submit(generate, normal_prompt)
+            summary_response = generate(summary_prompt)
+            full_response = full_future.result()
 
+        # Step 5: Optional verification
         full_response_verified = verify_answer(full_response, summary_response)
         return full_response_verified, retrieved_context, True, summary_response
 
     elif is_summary_request:
-        summary_response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": summary_prompt}]
-        ).choices[0].message.content
+        return generate(summary_prompt), retrieved_context, True
+
+    else:
+        return generate(normal_prompt), retrieved_context, True
+
+# -----------------------------
+# Query RAG (async)
+# -----------------------------
+async def aembed_query(question: str) -> np.ndarray:
+    """Embed one question on the async client (through the embedding cache); returns a (1, dim) float32 array."""
+    return await aembed_queries([question])
 
-        return summary_response, retrieved_context, True
 
+async def aembed_queries(questions: list[str]) -> np.ndarray:
+    """
+    Embed many questions on the async client: cached ones are not sent, the
+    rest go out in as few size-bounded requests as possible (run concurrently).
+    Returns a float32 array with one row per question, in input order.
+    The SQLite cache is read and written in a worker thread, never on the event loop.
+    """
+    if embedding_cache:
+        cached = await asyncio.to_thread(embedding_cache.get_many, EMBED_MODEL, questions)
     else:
-        full_response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": normal_prompt}]
-        ).choices[0].message.content
+        cached = [None] * len(questions)
+    missing = list(dict.fromkeys(q for q, v in zip(questions, cached) if v is None))
+
+    async def embed(batch):
+        response = await async_client.embeddings.create(model=EMBED_MODEL, input=batch)
+        vectors = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        if embedding_cache:
+            await asyncio.to_thread(embedding_cache.put_many, EMBED_MODEL, batch, vectors)
+        return zip(batch, vectors)
+
+    new_vectors = {}
+    for pairs in await asyncio.gather(*(embed(missing[start:end]) for start, end in batch_ranges(missing))):
+        new_vectors.update(pairs)
+
+    return np.array([v if v is not None else new_vectors[q] for q, v in zip(questions, cached)]).astype("float32")
+
+
+async def aretrieve(question: str, k: int = 3, q_embed: np.ndarray = None, files: list[str] = None):
+    """
+    Embed the question on the async client and return the retrieved chunk records.
+    Pass q_embed to reuse an embedding the caller already has. Without one, a
+    confident lexical match is returned without embedding the question.
+    files limits the search to those uploaded files.
+    The searches are CPU-bound, so they run in a worker thread instead of on the event loop.
+    """
+    snapshot = await asyncio.to_thread(current_snapshot)  # may pick up other workers' writes
+    if not snapshot.segments.count:
+        return []
+    if q_embed is None:
+        retrieved = await asyncio.to_thread(lexical_fast_path_records, question, k, snapshot, files)
+        if retrieved is not None:
+            return retrieved
+        q_embed = await aembed_query(question)
+    return await asyncio.to_thread(search_index, q_embed, k, snapshot, question, files)
+
+
+async def aretrieve_batch(questions: list[str], k: int = 3, q_embeds: np.ndarray = None):
+    """
+    aretrieve for many questions: one embedding request (for uncached questions)
+    and one matrix search. Returns one list of chunk records per question, in order.
+    """
+    snapshot = await asyncio.to_thread(current_snapshot)
+    if not snapshot.segments.count or not questions:
+        return [[] for _ in questions]
+    if q_embeds is None and RETRIEVAL_MODE != "lexical":
+        q_embeds = await aembed_queries(questions)
+    return await asyncio.to_thread(search_index_batch, q_embeds, k, snapshot, questions)
+
+
+async def agenerate_answer(question: str, retrieved, mode: str = "auto"):
+    """
+    Async-native generation step of query_rag, for callers that already retrieved
+    the chunks with aretrieve (e.g. to start reasoning summarization on the same
+    chunks at the same time). Returns the same tuple as query_rag.
+    """
+    # Prepare concise context snippets for frontend
+    retrieved_context = context_snippets(retrieved)
+    if not retrieved_context:
+        return "", retrieved_context, False
+
+    # Construct prompts (token counting, in a worker thread)
+    normal_prompt, summary_prompt, is_summary_request = await asyncio.to_thread(build_prompts, question, retrieved)
+
+    async def generate(prompt):
+        response = await async_client.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=[{"role": "user", "content": prompt}]
+        )
+        return response.choices[0].message.content
+
+    # Generate answers
+    if mode == "always":
+        # Both prompts only depend on the retrieved context, so run them concurrently
+        full_response, summary_response = await asyncio.gather(
+            generate(normal_prompt), generate(summary_prompt)
+        )
+
+        # Optional verification
+        full_response_verified = verify_answer(full_response, summary_response)
+        return full_response_verified, retrieved_context, True, summary_response
+
+    elif is_summary_request:
+        return await generate(summary_prompt), retrieved_context, True
+
+    else:
+        return await generate(normal_prompt), retrieved_context, True
+
+
+# -----------------------------
+# Query RAG (streaming)
+# -----------------------------
+async def astream_rag(question: str, k: int = 3, q_embed: np.ndarray = None, files: list[str] = None,
+                      retrieved=None):
+    """
+    Streaming version of aretrieve + agenerate_answer ("auto" mode); pass retrieved
+    to reuse chunk records the caller already has.
+    Yields ("sources", filenames) and ("context", retrieved_context) as soon as
+    retrieval is done, then ("token", text) for each piece of the answer as the
+    model produces it.
+    """
+    # Step 1: Embed question and search FAISS
+    if retrieved is None:
+        retrieved = await aretrieve(question, k, q_embed, files)
+    yield "sources", source_files(retrieved)
+
+    # Step 2: Send concise context snippets first
+    retrieved_context = context_snippets(retrieved)
+    yield "context", retrieved_context
+    if not retrieved_context:
+        return
 
-        return full_response, retrieved_context, True
\ No newline at end of file
+    # Step 3: Stream the full or summarized answer
+    normal_prompt, summary_prompt, is_summary_request = await asyncio.to_thread(build_prompts, question, retrieved)
+    stream = await async_client.chat.completions.create(
+        model=CHAT_MODEL,
+        messages=[{"role": "user", "content": summary_prompt if is_summary_request else normal_prompt}],
+        stream=True,
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield "token", chunk.choices[0].delta.content
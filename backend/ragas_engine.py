@@ -4,10 +4,18 @@ RAGAS + DeepEval Integrated Evaluation Engine
 - Summarized reasoning
 - Combined metrics (DeepEval + RAGAS)
 - Uses all recommended + optional RAGAS metrics
+- Answer + reasoning generated on the shared AsyncOpenAI client (no thread hops)
+- Streaming variant (ragas_generate_stream) for Server-Sent Events
+- Answer generation and reasoning summary run concurrently on the same retrieved chunks
+- Metric evaluation goes through eval_scheduler (bounded, interactive queries first)
+- DeepEval and RAGAS suites run concurrently; each one's scores are cached as soon as it finishes
+- DeepEval runs on a shared evaluator service that batches answers evaluated around the same time
+- RAGAS micro-batched: pending answers (up to RAGAS_BATCH_SIZE or RAGAS_BATCH_WAIT_MS) form one dataset
 """
 
 import asyncio
-from deepeval_utils import evaluate_rag
+import os
+from deepeval_utils import deepeval_service
 from ragas import evaluate as ragas_evaluate
 from ragas.metrics import (
     faithfulness,
@@ -21,32 +29,54 @@ from ragas.metrics import (
 )
 from datasets import Dataset
 from cache import answers_cache
-from openai import OpenAI
-import os
-
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+from eval_scheduler import eval_scheduler, PRIORITY_INTERACTIVE
+from micro_batch import MicroBatcher
 
 # -------------------------
 # Evaluate RAGAS metrics
 # -------------------------
+RAGAS_BATCH_SIZE = int(os.getenv("RAGAS_BATCH_SIZE", "16"))            # rows per ragas.evaluate() call
+RAGAS_BATCH_WAIT_MS = float(os.getenv("RAGAS_BATCH_WAIT_MS", "200"))  # wait for more answers before evaluating
+
+RAGAS_SCORE_COLUMNS = {
+    "Faithfulness": "faithfulness",
+    "AnswerRelevancy": "answer_relevancy",
+    "ContextPrecision": "context_precision",
+    "ContextRecall": "context_recall",
+    "AnswerCorrectness": "answer_correctness",
+    "AnswerSimilarity": "answer_similarity",
+    "MultiModalFaithfulness": "faithful_rate",
+    "MultiModalRelevance": "relevance_rate",
+}
+
+
+def normalize_context(context):
+    if isinstance(context, str):
+        return [context]
+    return [str(c).strip() for c in context if c]
+
+
 def evaluate_ragas(question: str, answer: str, context: list):
     """
     Run RAGAS metrics for a single question-answer-context trio.
     Supports all recommended + optional metrics.
     """
-    scores_dict = {}
-    try:
-        # Normalize context
-        if isinstance(context, str):
-            context = [context]
-        elif isinstance(context, list):
-            context = [str(c).strip() for c in context if c]
+    return evaluate_ragas_batch([(question, answer, context)])[0]
 
+
+def evaluate_ragas_batch(items: list):
+    """
+    Run RAGAS metrics for many (question, answer, context) trios as one dataset.
+    Returns one scores dict per item, in order (empty if evaluation failed).
+    """
+    scores = [{} for _ in items]
+    try:
+        contexts = [normalize_context(context) for _, _, context in items]
         data = {
-            "question": [question],
-            "answer": [answer],
-            "contexts": [context],
-            "reference": [answer],  # Required for context-based metrics
+            "question": [question for question, _, _ in items],
+            "answer": [answer for _, answer, _ in items],
+            "contexts": contexts,
+            "reference": [answer for _, answer, _ in items],  # Required for context-based metrics
         }
 
         dataset = Dataset.from_dict(data)
@@ -65,84 +95,169 @@ def evaluate_ragas(question: str, answer: str, context: list):
 
         ragas_results = ragas_evaluate(dataset=dataset, metrics=metrics_list)
 
-        # Directly extract values from EvaluationResult, just like your previous working code
-        scores_dict = {
-            "Faithfulness": float(ragas_results["faithfulness"][0]),
-            "AnswerRelevancy": float(ragas_results["answer_relevancy"][0]),
-            "ContextPrecision": float(ragas_results["context_precision"][0]),
-            "ContextRecall": float(ragas_results["context_recall"][0]),
-            "AnswerCorrectness": float(ragas_results["answer_correctness"][0]),
-            "AnswerSimilarity": float(ragas_results["answer_similarity"][0]),
-            "MultiModalFaithfulness": float(ragas_results["faithful_rate"][0]),
-            "MultiModalRelevance": float(ragas_results["relevance_rate"][0]),
-        }
+        # Directly extract each row's values from EvaluationResult
+        columns = {name: ragas_results[column] for name, column in RAGAS_SCORE_COLUMNS.items()}
+        scores = [{name: float(values[i]) for name, values in columns.items()} for i in range(len(items))]
 
     except Exception as e:
         print(f"[RAGAS] Evaluation failed: {e}")
 
-    return scores_dict
+    return scores
+
+
+# Answers evaluated around the same time share one dataset and one ragas.evaluate() call
+ragas_batcher = MicroBatcher(
+    evaluate_ragas_batch, RAGAS_BATCH_SIZE, RAGAS_BATCH_WAIT_MS, run=eval_scheduler.run_in_pool, name="RAGAS",
+)
+
+# -------------------------
+# Summarize retrieved context into reasoning
+# -------------------------
+async def summarize_reasoning(context: list, summarize: bool = True):
+    """Turn the retrieved context snippets into a short reasoning text."""
+    from rag_engine import async_client  # dynamic import to avoid circular dependency
+    clean_context = [c.replace("\t", " ").replace("\n", " ").strip() for c in context]
+    if not summarize:
+        return "\n".join(clean_context)
+
+    prompt = (
+        "Summarize the following retrieved context into a concise, readable explanation "
+        "that clearly answers the user's question:\n\n" + "\n".join(clean_context)
+    )
+    try:
+        response = await async_client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.3,
+            max_tokens=300,
+        )
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        print(f"[Summarization] Failed: {e}")
+        return "\n".join(clean_context)
 
 # -------------------------
 # Generate answer + reasoning + metrics
 # -------------------------
-async def ragas_generate(question: str, summarize: bool = True):
-    """Generate RAG answer + reasoning and compute metrics asynchronously."""
-    from rag_engine import query_rag  # dynamic import to avoid circular dependency
-    answer, context, relevant = await asyncio.to_thread(query_rag, question)
-    reasoning = None
+def schedule_metrics(question, answer, context, reasoning, key=None, priority: int = PRIORITY_INTERACTIVE):
+    """Queue metric computation on the evaluation scheduler."""
+    def on_drop():
+        # Runs on the next loop turn, after the caller has stored the answer in the cache
+        asyncio.get_running_loop().call_soon(
+            lambda: answers_cache.update_entry(key or question, metrics=METRICS_SKIPPED)
+        )
+
+    eval_scheduler.submit(
+        compute_metrics_async, question, answer, context, reasoning, key, priority=priority, on_drop=on_drop
+    )
+
+
+METRICS_SKIPPED = {"DeepEval": "Skipped (evaluation queue full)", "RAGAS": "Skipped (evaluation queue full)"}
+
+
+async def ragas_generate(question: str, summarize: bool = True, key=None, q_embed=None, retrieved=None,
+                         priority: int = PRIORITY_INTERACTIVE, files: list = None):
+    """
+    Generate RAG answer + reasoning and compute metrics asynchronously.
+    The reasoning summary only needs the retrieved context, so it runs at the
+    same time as answer generation instead of after it.
+    key: answers_cache key the metrics are written to (defaults to the question).
+    q_embed: question embedding, if the caller already computed it.
+    retrieved: chunk records, if the caller already searched (e.g. a batch query).
+    priority: evaluation scheduler priority for the metrics.
+    files: limit retrieval to these uploaded files.
+    Returns (answer, context, reasoning, relevant, sources).
+    """
+    from rag_engine import aretrieve, agenerate_answer, context_snippets, source_files  # dynamic import to avoid circular dependency
+    if retrieved is None:
+        retrieved = await aretrieve(question, q_embed=q_embed, files=files)
+    context = context_snippets(retrieved)
+    sources = source_files(retrieved)
+    if not context:
+        return "", context, None, False, sources
+
+    (answer, context, relevant), reasoning = await asyncio.gather(
+        agenerate_answer(question, retrieved),
+        summarize_reasoning(context, summarize),
+    )
 
     if relevant and context:
-        clean_context = [c.replace("\t", " ").replace("\n", " ").strip() for c in context]
-
-        # Summarize reasoning
-        if summarize:
-            prompt = (
-                "Summarize the following retrieved context into a concise, readable explanation "
-                "that clearly answers the user's question:\n\n" + "\n".join(clean_context)
-            )
-            try:
-                response = await asyncio.to_thread(
-                    lambda: client.chat.completions.create(
-                        model="gpt-3.5-turbo",
-                        messages=[{"role": "user", "content": prompt}],
-                        temperature=0.3,
-                        max_tokens=300,
-                    )
-                )
-                reasoning = response.choices[0].message.content.strip()
-            except Exception as e:
-                print(f"[Summarization] Failed: {e}")
-                reasoning = "\n".join(clean_context)
-        else:
-            reasoning = "\n".join(clean_context)
-
-        # Compute metrics asynchronously (background task)
-        asyncio.create_task(compute_metrics_async(question, answer, context, reasoning))
-
-    return answer, context, reasoning, relevant
+        # Compute metrics asynchronously (scheduled background work)
+        schedule_metrics(question, answer, context, reasoning, key, priority)
+
+    return answer, context, reasoning, relevant, sources
 
 # -------------------------
-# Compute metrics async
+# Streamed answer + reasoning + metrics
 # -------------------------
-async def compute_metrics_async(question, answer, context, reasoning):
-    """Compute both DeepEval and RAGAS metrics asynchronously and cache results."""
+async def ragas_generate_stream(question: str, summarize: bool = True, key=None, q_embed=None, files: list = None,
+                                retrieved=None):
+    """
+    Streaming version of ragas_generate. Yields (event, data) pairs:
+    "context" (snippets), "token" (answer pieces), "reasoning" and finally
+    "done" with the full answer, context, reasoning, relevance flag and sources. retrieved: chunk records, if the caller already searched.
+    """
+    from rag_engine import astream_rag  # dynamic import to avoid circular dependency
+    context, tokens, sources = [], [], []
+    reasoning_task = None
+
     try:
-        print(f"[Metrics] Starting computation for: {question}")
+        async for event, data in astream_rag(question, q_embed=q_embed, files=files, retrieved=retrieved):
+            if event == "sources":
+                sources = data
+                continue  # reported in "done", so clients still get "context" first
+            elif event == "context":
+                context = data
+                if context:
+                    # Summarize reasoning while the answer is still streaming
+                    reasoning_task = asyncio.create_task(summarize_reasoning(context, summarize))
+            else:
+                tokens.append(data)
+            yield event, data
 
-        deepeval_scores = await asyncio.to_thread(evaluate_rag, question, answer, context)
-        print(f"[Metrics] DeepEval done for: {question}")
+        answer = "".join(tokens)
+        relevant = bool(context)
+        reasoning = None
 
-        ragas_scores = await asyncio.to_thread(evaluate_ragas, question, answer, context)
-        print(f"[Metrics] RAGAS done for: {question}")
+        if relevant:
+            reasoning = await reasoning_task
+            yield "reasoning", reasoning
 
-        combined_scores = {"DeepEval": deepeval_scores, "RAGAS": ragas_scores}
+            # Compute metrics asynchronously (scheduled background work)
+            schedule_metrics(question, answer, context, reasoning, key)
+    finally:
+        # Client disconnected mid-stream: don't leave the summary running
+        if reasoning_task and not reasoning_task.done():
+            reasoning_task.cancel()
 
-        # Update cache
-        if question in answers_cache:
-            answers_cache[question]["metrics"] = combined_scores
-            answers_cache[question]["reasoning"] = reasoning
+    yield "done", {"answer": answer, "context": context, "reasoning": reasoning, "relevant": relevant,
+                   "sources": sources}
 
+# -------------------------
+# Compute metrics async
+# -------------------------
+async def compute_metrics_async(question, answer, context, reasoning, key=None):
+    """
+    Compute DeepEval and RAGAS metrics concurrently and cache the results.
+    Each suite's scores are written to the cache as soon as it finishes, so
+    /metrics can show one while the other is still computing.
+    """
+    scores = {}
+
+    async def run_suite(name, evaluation):
+        result = await evaluation
+        print(f"[Metrics] {name} done for: {question}")
+        scores[name] = result
+        # Update cache with a fresh dict (no-op if the entry was evicted or expired meanwhile)
+        answers_cache.update_entry(key or question, metrics=dict(scores), reasoning=reasoning)
+
+    try:
+        print(f"[Metrics] Starting computation for: {question}")
+        await asyncio.gather(
+            run_suite("DeepEval", deepeval_service.aevaluate(question, answer, context)),
+            run_suite("RAGAS", ragas_batcher.submit((question, answer, context))),
+        )
         print(f"[Metrics] Completed for: {question}")
 
     except Exception as e:
-        print(f"[Metrics] Computation failed: {e}")
\ No newline at end of file
+        print(f"[Metrics] Computation failed: {e}")
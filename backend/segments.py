@@ -0,0 +1,397 @@
+"""
+Segmented chunk storage for rag_engine snapshots.
+
+A SegmentSet holds the indexed chunks as a tuple of immutable segments, each
+with its own chunk ids, vectors, chunk metadata (ChunkStore) and, for a
+trained IVF/HNSW base, its own FAISS index. Segments cover disjoint,
+ascending chunk id ranges, so a new snapshot never copies what the old one
+already holds:
+- adding chunks appends one segment built from just those chunks
+- removing chunks records their ids as tombstones, which every search skips
+- merges run in the background (see plan_merge): small neighbouring segments
+  are combined, and a compaction rewrites everything into one base without
+  the tombstoned rows (training the configured FAISS backend on it)
+Segments without a FAISS index (all segments of the flat backend, the newest
+ones of a trained backend) are searched exactly with NumPy on their vectors,
+which are memory-mapped slices of the vector store when there is one.
+
+Row r of a SegmentSet is row r of its segments laid end to end, tombstoned
+rows included; rows are only meaningful within one SegmentSet.
+"""
+
+import os
+from typing import NamedTuple
+
+import faiss
+import numpy as np
+
+import index_factory
+from chunk_store import ChunkStore
+
+SEGMENT_MERGE_RATIO = float(os.getenv("SEGMENT_MERGE_RATIO", "1"))   # merge into the older neighbour while it is at most this many times larger
+SEGMENT_MAX_COUNT = int(os.getenv("SEGMENT_MAX_COUNT", "32"))        # merge the smallest neighbours beyond this many segments
+MERGE_DELETED_RATIO = float(os.getenv("MERGE_DELETED_RATIO", "0.2"))  # compact once this share of rows are tombstones
+MERGE_DELTA_RATIO = float(os.getenv("MERGE_DELTA_RATIO", "0.1"))      # fold exact-search segments into a trained base past this share of it
+EXACT_BLOCK_ROWS = 65536  # rows per exact-search block, bounds the distance matrix
+
+
+class Segment(NamedTuple):
+    chunk_ids: np.ndarray           # ascending int64
+    embeddings: np.ndarray          # float32 rows aligned with chunk_ids
+    chunks: ChunkStore              # rows aligned with chunk_ids
+    index: object = None            # trained FAISS index over the live rows; None = exact search
+    norms: np.ndarray = None        # squared L2 norm per row, for exact search
+    store_rows: tuple = None        # (first, end) rows of the vector store files holding the segment
+
+
+class Scope(NamedTuple):
+    id_ranges: np.ndarray  # sorted (n, 2) [first_id, end_id) ranges of the chunks in scope
+    rows: dict             # segment position -> [(start, end) local row ranges]
+    size: int              # chunks in scope
+
+
+def squared_norms(vectors: np.ndarray) -> np.ndarray:
+    norms = np.empty(len(vectors), dtype="float32")
+    for start in range(0, len(vectors), EXACT_BLOCK_ROWS):
+        block = np.asarray(vectors[start:start + EXACT_BLOCK_ROWS], dtype="float32")
+        norms[start:start + len(block)] = np.einsum("ij,ij->i", block, block)
+    return norms
+
+
+def make_segment(chunk_ids: np.ndarray, embeddings: np.ndarray, chunks: ChunkStore, index=None,
+                 store_rows: tuple = None) -> Segment:
+    norms = squared_norms(embeddings) if index is None else None
+    return Segment(np.asarray(chunk_ids, dtype="int64"), embeddings, chunks, index, norms, store_rows)
+
+
+def concat_segments(parts: tuple, embeddings: np.ndarray = None, store_rows: tuple = None) -> Segment:
+    """
+    One index-less segment holding the rows of parts (tombstoned rows included).
+    embeddings: the parts' vectors if already at hand, e.g. mapped from the vector
+    store when the parts are adjacent there; concatenated otherwise.
+    """
+    if embeddings is None:
+        embeddings = np.concatenate([part.embeddings for part in parts])
+    return Segment(
+        np.concatenate([part.chunk_ids for part in parts]),
+        embeddings,
+        ChunkStore.concat([part.chunks for part in parts]),
+        None,
+        np.concatenate([part.norms if part.norms is not None else squared_norms(part.embeddings) for part in parts]),
+        store_rows,
+    )
+
+
+class SegmentSet:
+    """Immutable: segments, tombstoned chunk ids and the chunk id ranges of every live file."""
+
+    def __init__(self, segments: tuple = (), deleted: np.ndarray = None, file_ranges: dict = None):
+        self.segments = tuple(segments)
+        sizes = [len(segment.chunk_ids) for segment in self.segments]
+        self.starts = np.concatenate([[0], np.cumsum(sizes)]).astype("int64")  # first row of each segment
+        self.first_ids = np.array([segment.chunk_ids[0] for segment in self.segments], dtype="int64")
+        self.deleted = deleted if deleted is not None else np.empty(0, dtype="int64")  # sorted
+        self.file_ranges = file_ranges if file_ranges is not None else {}  # filename -> ((first_id, end_id), ...)
+        self.rows = int(self.starts[-1])
+        self.count = self.rows - len(self.deleted)  # live chunks
+        self._dead = {}  # segment position -> (local rows, FAISS selector) of its tombstones, built on demand
+
+    @classmethod
+    def from_segments(cls, segments, deleted: np.ndarray = None) -> "SegmentSet":
+        """Set whose file table is rebuilt from the segments' live rows (loading, not the write path)."""
+        deleted = deleted if deleted is not None else np.empty(0, dtype="int64")
+        file_ranges = {}
+        for segment in segments:
+            live = ~np.isin(segment.chunk_ids, deleted)
+            for name, ranges in segment.chunks.ranges.items():
+                for start, end in ranges:
+                    # Split each file range at tombstoned rows
+                    runs = np.flatnonzero(np.diff(np.concatenate([[False], live[start:end], [False]]).astype("int8")))
+                    for run_start, run_end in runs.reshape(-1, 2).tolist():
+                        _add_file_range(file_ranges, name, segment.chunk_ids, start + run_start, start + run_end)
+        file_ranges = {name: tuple(sorted(ranges)) for name, ranges in file_ranges.items()}
+        return cls(segments, deleted, file_ranges)
+
+    @property
+    def dim(self) -> int:
+        return self.segments[0].embeddings.shape[1] if self.segments else 0
+
+    # -----------------------------
+    # Copy-on-write updates
+    # -----------------------------
+    def append(self, segment: Segment) -> "SegmentSet":
+        """New set with segment (ids above every existing id) added at the end."""
+        file_ranges = dict(self.file_ranges)
+        for name, ranges in segment.chunks.ranges.items():
+            for start, end in ranges:
+                _add_file_range(file_ranges, name, segment.chunk_ids, start, end)
+        return SegmentSet(self.segments + (segment,), self.deleted, file_ranges)
+
+    def remove_files(self, filenames) -> tuple:
+        """(new set with the files' chunks tombstoned, their chunk ids, their texts)."""
+        scope = self.scope(filenames)
+        removed_ids, texts = [], []
+        for position, ranges in scope.rows.items():
+            segment = self.segments[position]
+            for start, end in ranges:
+                removed_ids.append(segment.chunk_ids[start:end])
+                texts.extend(segment.chunks.chunk(row) for row in range(start, end))
+        removed_ids = np.concatenate(removed_ids) if removed_ids else np.empty(0, dtype="int64")
+        removed = set(filenames)
+        file_ranges = {name: ranges for name, ranges in self.file_ranges.items() if name not in removed}
+        return SegmentSet(self.segments, np.union1d(self.deleted, removed_ids), file_ranges), removed_ids, texts
+
+    def remove_ids(self, chunk_ids) -> tuple:
+        """remove_files for individual chunk ids; ids that are unknown or already removed are skipped."""
+        chunk_ids = np.setdiff1d(np.asarray(chunk_ids, dtype="int64"), self.deleted)
+        chunk_ids = chunk_ids[chunk_ids >= self.first_ids[0]] if self.rows else chunk_ids[:0]
+        rows = np.minimum(self.rows_of(chunk_ids), self.rows - 1)
+        present = self.ids(rows) == chunk_ids
+        chunk_ids, rows = chunk_ids[present], rows[present]
+
+        records = self.records(rows)
+        by_file = {}
+        for chunk_id, record in zip(chunk_ids.tolist(), records):
+            by_file.setdefault(record["filename"], []).append(chunk_id)
+        file_ranges = dict(self.file_ranges)
+        for name, removed in by_file.items():
+            # Cut the removed ids (ascending) out of the file's ranges
+            kept = []
+            for first_id, end_id in file_ranges.get(name, ()):
+                for chunk_id in removed:
+                    if first_id <= chunk_id < end_id:
+                        if chunk_id > first_id:
+                            kept.append((first_id, chunk_id))
+                        first_id = chunk_id + 1
+                if first_id < end_id:
+                    kept.append((first_id, end_id))
+            if kept:
+                file_ranges[name] = tuple(kept)
+            else:
+                file_ranges.pop(name, None)
+        texts = [record["chunk"] for record in records]
+        return SegmentSet(self.segments, np.union1d(self.deleted, chunk_ids), file_ranges), chunk_ids, texts
+
+    def replace(self, first: int, end: int, merged: tuple) -> "SegmentSet":
+        """New set with segments[first:end] replaced by merged, which hold the same rows."""
+        return SegmentSet(self.segments[:first] + tuple(merged) + self.segments[end:], self.deleted, self.file_ranges)
+
+    # -----------------------------
+    # Row access
+    # -----------------------------
+    def locate(self, rows: np.ndarray) -> tuple:
+        """(segment position, local row) arrays for rows."""
+        rows = np.asarray(rows, dtype="int64")
+        positions = np.searchsorted(self.starts, rows, side="right") - 1
+        return positions, rows - self.starts[positions]
+
+    def rows_of(self, chunk_ids: np.ndarray) -> np.ndarray:
+        """Rows of chunk ids present in the set."""
+        chunk_ids = np.asarray(chunk_ids, dtype="int64")
+        positions = np.searchsorted(self.first_ids, chunk_ids, side="right") - 1
+        rows = np.empty(len(chunk_ids), dtype="int64")
+        for position in np.unique(positions).tolist():
+            selected = positions == position
+            rows[selected] = self.starts[position] + np.searchsorted(
+                self.segments[position].chunk_ids, chunk_ids[selected]
+            )
+        return rows
+
+    def _gather(self, rows, column: str, out: np.ndarray) -> np.ndarray:
+        positions, local = self.locate(rows)
+        for position in np.unique(positions).tolist():
+            selected = positions == position
+            out[selected] = getattr(self.segments[position], column)[local[selected]]
+        return out
+
+    def ids(self, rows) -> np.ndarray:
+        return self._gather(rows, "chunk_ids", np.empty(len(rows), dtype="int64"))
+
+    def vectors(self, rows) -> np.ndarray:
+        return self._gather(rows, "embeddings", np.empty((len(rows), self.dim), dtype="float32"))
+
+    def records(self, rows) -> list[dict]:
+        positions, local = self.locate(rows)
+        return [self.segments[p].chunks.record(r) for p, r in zip(positions.tolist(), local.tolist())]
+
+    def file_codes(self, rows) -> np.ndarray:
+        """Small integer per row, equal for rows of the same file."""
+        positions, local = self.locate(rows)
+        codes = {}
+        names = [self.segments[p].chunks.filename(r) for p, r in zip(positions.tolist(), local.tolist())]
+        return np.array([codes.setdefault(name, len(codes)) for name in names], dtype="int32")
+
+    def live_chunks(self) -> tuple:
+        """(chunk ids, texts) of every live chunk, in id order."""
+        ids, texts = [], []
+        for position, segment in enumerate(self.segments):
+            live = np.flatnonzero(self.live_mask(position))
+            ids.append(segment.chunk_ids[live])
+            texts.extend(segment.chunks.chunk(row) for row in live.tolist())
+        return (np.concatenate(ids) if ids else np.empty(0, dtype="int64")), texts
+
+    def live_mask(self, position: int) -> np.ndarray:
+        """Boolean mask of the rows of segments[position] that are not tombstoned."""
+        live = np.ones(len(self.segments[position].chunk_ids), dtype=bool)
+        live[self._dead_rows(position)[0]] = False
+        return live
+
+    # -----------------------------
+    # Per-file views
+    # -----------------------------
+    def files(self) -> list[str]:
+        """Names of the files that have live chunks, in first-seen order."""
+        return list(self.file_ranges)
+
+    def has_file(self, filename: str) -> bool:
+        return filename in self.file_ranges
+
+    def scope(self, filenames) -> Scope:
+        """The chunks of filenames, located from the file table: O(ranges of those files), not O(corpus)."""
+        id_ranges = sorted(r for name in dict.fromkeys(filenames) for r in self.file_ranges.get(name, ()))
+        rows, size = {}, 0
+        for first_id, end_id in id_ranges:
+            position = max(int(np.searchsorted(self.first_ids, first_id, side="right")) - 1, 0)
+            while position < len(self.segments) and self.first_ids[position] < end_id:
+                chunk_ids = self.segments[position].chunk_ids
+                start, end = np.searchsorted(chunk_ids, [first_id, end_id]).tolist()
+                if end > start:
+                    rows.setdefault(position, []).append((start, end))
+                    size += end - start
+                position += 1
+        return Scope(np.array(id_ranges, dtype="int64").reshape(-1, 2), rows, size)
+
+    # -----------------------------
+    # Vector search
+    # -----------------------------
+    def _dead_rows(self, position: int) -> tuple:
+        """(local rows, FAISS selector excluding them) of the tombstones in one segment."""
+        if position not in self._dead:
+            chunk_ids = self.segments[position].chunk_ids
+            lo = np.searchsorted(self.deleted, chunk_ids[0], side="left")
+            hi = np.searchsorted(self.deleted, chunk_ids[-1], side="right")
+            dead_ids = self.deleted[lo:hi]
+            selector = None
+            if len(dead_ids):
+                batch = faiss.IDSelectorBatch(dead_ids)
+                selector = (faiss.IDSelectorNot(batch), batch)  # keep the inner selector referenced
+            self._dead[position] = (np.searchsorted(chunk_ids, dead_ids), selector)
+        return self._dead[position]
+
+    def search(self, q_embeds: np.ndarray, k: int, scope: Scope = None, exact_max_rows: int = 0) -> list:
+        """
+        L2 search over every segment (within scope, if given), skipping tombstones.
+        Segments with a FAISS index answer through it, unless the scope leaves
+        at most exact_max_rows of their rows; the rest are searched exactly.
+        Returns best-first rows per query.
+        """
+        q_embeds = np.ascontiguousarray(q_embeds, dtype="float32")
+        distances, rows = [], []
+        for position, segment in enumerate(self.segments):
+            ranges = None
+            if scope is not None:
+                ranges = scope.rows.get(position)
+                if not ranges:
+                    continue
+            dead, exclude = self._dead_rows(position)
+            in_scope = sum(end - start for start, end in ranges) if ranges else len(segment.chunk_ids)
+            if segment.index is None or in_scope <= exact_max_rows:
+                D, local = exact_search(segment, q_embeds, k, ranges or [(0, len(segment.chunk_ids))], dead)
+            else:
+                selector = exclude
+                if ranges:
+                    batch = faiss.IDSelectorBatch(np.concatenate([segment.chunk_ids[s:e] for s, e in ranges]))
+                    selector = (batch,)
+                params = index_factory.search_params(segment.index, selector=selector[0] if selector else None)
+                D, I = segment.index.search(q_embeds, k, params=params)
+                found = I >= 0  # -1 pads results when k exceeds the rows searched
+                local = np.where(found, np.searchsorted(segment.chunk_ids, I), -1)
+                D = np.where(found, D, np.inf)
+            distances.append(D)
+            rows.append(np.where(local >= 0, local + self.starts[position], -1))
+        if not distances:
+            return [np.empty(0, dtype="int64") for _ in range(len(q_embeds))]
+
+        distances, rows = np.concatenate(distances, axis=1), np.concatenate(rows, axis=1)
+        results = []
+        for D, R in zip(distances, rows):
+            order = np.argsort(D, kind="stable")[:k]
+            results.append(R[order][np.isfinite(D[order])])
+        return results
+
+
+def exact_search(segment: Segment, q_embeds: np.ndarray, k: int, ranges: list, dead: np.ndarray) -> tuple:
+    """
+    Exact L2 top-k over the given local row ranges of a segment, block by block
+    (each block is a slice of the vectors, so a memory-mapped segment is read in place).
+    Returns (distances, local rows), padded with (inf, -1).
+    """
+    q_norms = np.einsum("ij,ij->i", q_embeds, q_embeds)[:, None]
+    best_d = np.full((len(q_embeds), 0), np.inf, dtype="float32")
+    best_r = np.full((len(q_embeds), 0), -1, dtype="int64")
+    for range_start, range_end in ranges:
+        for start in range(range_start, range_end, EXACT_BLOCK_ROWS):
+            end = min(range_end, start + EXACT_BLOCK_ROWS)
+            vectors = np.asarray(segment.embeddings[start:end], dtype="float32")
+            norms = segment.norms[start:end] if segment.norms is not None else squared_norms(vectors)
+            D = q_norms + norms - 2 * (q_embeds @ vectors.T)
+            block_dead = dead[(dead >= start) & (dead < end)] - start
+            D[:, block_dead] = np.inf
+
+            D = np.concatenate([best_d, D], axis=1)
+            R = np.concatenate([best_r, np.broadcast_to(np.arange(start, end), (len(q_embeds), end - start))], axis=1)
+            if D.shape[1] > k:
+                top = np.argpartition(D, k - 1, axis=1)[:, :k]
+                D, R = np.take_along_axis(D, top, axis=1), np.take_along_axis(R, top, axis=1)
+            best_d, best_r = D, R
+    best_r = np.where(np.isfinite(best_d), best_r, -1)
+    return best_d, best_r
+
+
+def _add_file_range(file_ranges: dict, name: str, chunk_ids: np.ndarray, start: int, end: int):
+    """Add local rows [start, end) of a segment to name's chunk id ranges, extending a range they continue."""
+    first_id, end_id = int(chunk_ids[start]), int(chunk_ids[end - 1]) + 1
+    previous = file_ranges.get(name, ())
+    if previous and previous[-1][1] == first_id:
+        file_ranges[name] = previous[:-1] + ((previous[-1][0], end_id),)
+    else:
+        file_ranges[name] = previous + ((first_id, end_id),)
+
+
+# -----------------------------
+# Merge planning
+# -----------------------------
+def plan_merge(segment_set: SegmentSet, kind: str):
+    """
+    Next background merge for the set, or None:
+    - ("compact", None): rewrite every segment into one base without tombstones,
+      with a FAISS index of the given kind if there are enough rows to train it
+    - ("merge", (first, end)): combine the index-less segments[first:end] into one
+    """
+    segs = segment_set.segments
+    if not segs:
+        return None
+    if len(segment_set.deleted) > MERGE_DELETED_RATIO * segment_set.rows:
+        return "compact", None
+
+    trained = kind != "flat" and segment_set.count >= index_factory.min_training_points(kind)
+    base = segs[0]
+    if trained:
+        if base.index is None or index_factory.index_kind(base.index) != kind:
+            return "compact", None
+        if segment_set.rows - len(base.chunk_ids) > MERGE_DELTA_RATIO * len(base.chunk_ids):
+            return "compact", None
+    elif base.index is not None:
+        return "compact", None  # backend switched to flat, or too few chunks left to keep it trained
+
+    sizes = [len(segment.chunk_ids) for segment in segs]
+    mergeable = [segment.index is None for segment in segs]
+    for i in range(len(segs) - 1, 0, -1):
+        if mergeable[i - 1] and mergeable[i] and sizes[i - 1] <= SEGMENT_MERGE_RATIO * sizes[i]:
+            return "merge", (i - 1, i + 1)
+    if len(segs) > SEGMENT_MAX_COUNT:
+        pairs = [(sizes[i - 1] + sizes[i], i) for i in range(1, len(segs)) if mergeable[i - 1] and mergeable[i]]
+        if pairs:
+            i = min(pairs)[1]
+            return "merge", (i - 1, i + 1)
+    return None
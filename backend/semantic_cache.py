@@ -0,0 +1,92 @@
+"""
+Semantic answer cache: maps paraphrased questions onto already answered ones.
+
+Question embeddings are kept (L2-normalized) in a small inner-product FAISS
+index. A lookup returns the closest previously answered question whose
+cosine similarity passes the threshold; the caller then reads the answer from
+answers_cache under the current corpus version, so a match never returns an
+answer from a different corpus.
+"""
+
+import os
+
+import faiss
+import numpy as np
+
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))  # cosine similarity
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+SEMANTIC_CACHE_CANDIDATES = 4  # neighbours checked per lookup
+
+
+class SemanticCache:
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.index = None
+        self.questions = {}  # entry id -> (question, is_summary_request); insertion order = age
+        self.by_question = {}  # question -> entry id
+        self.next_id = 0
+
+        self.lookups = 0
+        self.hits = 0
+
+    @staticmethod
+    def _normalize(q_embed: np.ndarray) -> np.ndarray:
+        vec = np.array(q_embed, dtype="float32").reshape(1, -1)
+        faiss.normalize_L2(vec)
+        return vec
+
+    def lookup(self, q_embed: np.ndarray, is_summary_request: bool, has_answer):
+        """
+        Return (question, similarity) of the closest cached question above the
+        threshold for which has_answer(question) is true, else (None, best_similarity).
+        Only questions of the same kind (summary request or not) match.
+        """
+        self.lookups += 1
+        if self.index is None or self.index.ntotal == 0:
+            return None, 0.0
+
+        k = min(SEMANTIC_CACHE_CANDIDATES, self.index.ntotal)
+        D, I = self.index.search(self._normalize(q_embed), k)
+        best = float(D[0][0]) if I[0][0] != -1 else 0.0
+        for similarity, entry_id in zip(D[0], I[0]):
+            if entry_id == -1 or similarity < self.threshold:
+                break
+            question, summary = self.questions[int(entry_id)]
+            if summary == is_summary_request and has_answer(question):
+                self.hits += 1
+                return question, float(similarity)
+        return None, best
+
+    def add(self, q_embed: np.ndarray, question: str, is_summary_request: bool):
+        if question in self.by_question:
+            return
+        vec = self._normalize(q_embed)
+        if self.index is None:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(vec.shape[1]))
+
+        # Evict the oldest question once full
+        if len(self.questions) >= self.max_entries:
+            oldest_id = next(iter(self.questions))
+            oldest_question, _ = self.questions.pop(oldest_id)
+            del self.by_question[oldest_question]
+            self.index.remove_ids(np.array([oldest_id], dtype="int64"))
+
+        entry_id = self.next_id
+        self.next_id += 1
+        self.index.add_with_ids(vec, np.array([entry_id], dtype="int64"))
+        self.questions[entry_id] = (question, is_summary_request)
+        self.by_question[question] = entry_id
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.questions),
+            "threshold": self.threshold,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "misses": self.lookups - self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+        }
+
+
+semantic_cache = SemanticCache()
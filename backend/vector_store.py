@@ -0,0 +1,404 @@
+"""
+On-disk persistence for the segments and chunk metadata used by rag_engine.
+
+Layout of the store directory:
+- index.faiss      trained FAISS index (IVF / HNSW backends) over the first index_rows rows,
+                   written only when a background compaction rebuilds the base segment
+- vectors.f32      append-only float32 rows (one per chunk added since the last compaction)
+- vector_ids.i64   append-only int64 chunk ids, parallel to vectors.f32
+- chunks.jsonl     append-only log of {"op": "add"} / {"op": "remove"} records
+- meta.json        embedding dimension, index_rows, compaction generation and counters
+                   (next chunk id, corpus version)
+- store.lock       fcntl lock file serializing writers across processes
+
+Adds append their rows and removals a tombstone, so neither costs more than
+the chunks it touches. Compaction (rag_engine's background merge) rewrites
+the files without the removed rows: prepared off to the side by
+write_compacted, swapped in by finish_compaction together with whatever
+was appended meanwhile. Segments are served straight from the memory-mapped
+vector file (a flat backend never copies it into a FAISS index), and the
+trained index is loaded with IO_FLAG_MMAP_IFC, which memory-maps its codes,
+so several uvicorn workers on one host share the same pages.
+
+Several worker processes can write to one store. Every write holds the
+lock file and first calls read_changes(), which returns what the other
+processes appended or removed since this one last looked (the rows past
+its position, the log past its offset, their counters in meta.json), so
+chunk ids and corpus versions continue theirs. A compaction by another
+process bumps the generation in meta.json, which means a full reload.
+Loading also repairs what a crash mid-write can leave behind: vector and id
+files of different lengths, a partial last log line, a stale next_chunk_id,
+an index that does not match the rows it claims to cover.
+"""
+
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import NamedTuple
+
+import faiss
+import numpy as np
+
+from chunk_store import ChunkStore
+from segments import make_segment
+
+INDEX_FILE = "index.faiss"
+VECTORS_FILE = "vectors.f32"
+IDS_FILE = "vector_ids.i64"
+CHUNKS_FILE = "chunks.jsonl"
+RECORD_KEYS = ("filename", "chunk", "page", "start", "end")  # source offsets are absent in older logs
+META_FILE = "meta.json"
+LOCK_FILE = "store.lock"
+REMOVED_RECORD = {"filename": "", "chunk": ""}  # stands in for removed chunks until the next compaction
+
+
+class StoreChanges(NamedTuple):
+    """Writes other processes made since this one last loaded, wrote or read changes."""
+    reload: bool = False                 # the store was compacted: load it again from scratch
+    rows: tuple = (0, 0)                 # (first, end) rows appended
+    documents: dict = {}                 # chunk id -> record of the chunks added in those rows (and not removed)
+    removed: np.ndarray = np.empty(0, dtype="int64")  # ids of earlier chunks that were removed
+    meta: dict = {}                      # their counters (next_chunk_id, corpus_version)
+
+
+class VectorStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.dim = None
+        self.rows = 0        # rows in vectors.f32 / vector_ids.i64
+        self.log_bytes = 0   # bytes in chunks.jsonl
+        self.index_rows = 0  # leading rows covered by index.faiss
+        self.generation = 0  # compactions so far
+        self._meta_stamp = None  # (inode, mtime) of meta.json as last read or written by this process
+        self._thread_lock = threading.RLock()
+        self._lock_file = None  # open while this process holds the lock file
+        self._mapped = {}  # name -> vector / id file of the generation this process has loaded
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _compacted(self, name: str) -> str:
+        return self._file(f"{name}.{os.getpid()}.compact")
+
+    @contextmanager
+    def locked(self, shared: bool = False, blocking: bool = True):
+        """
+        Hold the store's cross-process lock (exclusive for writes, shared for reads);
+        re-entrant within a thread. With blocking=False, yields False instead of waiting.
+        """
+        if not self._thread_lock.acquire(blocking=blocking):
+            yield False
+            return
+        try:
+            if self._lock_file is not None:  # re-entered
+                yield True
+                return
+            lock = open(self._file(LOCK_FILE), "a")
+            try:
+                fcntl.flock(lock, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                lock.close()
+                yield False
+                return
+            self._lock_file = lock
+            try:
+                yield True
+            finally:
+                self._lock_file = None
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                lock.close()
+        finally:
+            self._thread_lock.release()
+
+    def _replace(self, name: str, write):
+        """Write a file through a temporary path and atomically swap it in."""
+        tmp = self._file(name + ".tmp")
+        write(tmp)
+        os.replace(tmp, self._file(name))
+
+    def position(self) -> tuple:
+        """(rows, log bytes) written so far; finish_compaction copies everything after it."""
+        return self.rows, self.log_bytes
+
+    # -----------------------------
+    # Load
+    # -----------------------------
+    def load(self):
+        """
+        Load the persisted state.
+        Returns (segments, deleted, meta), or None if the store is empty: the rows covered by
+        index.faiss as one base segment and the rest as one exact-search segment, both
+        viewing the memory-mapped vector files, and the sorted ids of removed chunks.
+        """
+        with self.locked():  # exclusive: loading may repair the files
+            meta = self._read_meta()
+            if meta is None:
+                return None
+            self.generation = meta.pop("generation", 0)
+            index_rows = meta.pop("index_rows", None)  # None: written before the base covered a row prefix
+
+            self.log_bytes = 0
+            self._close_mapped()
+            documents, _, max_logged_id = self._replay_log(repair=True)
+            self.rows = self._repair_vectors()
+
+            index = None
+            if os.path.exists(self._file(INDEX_FILE)):
+                index = faiss.read_index(self._file(INDEX_FILE), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+            ids = self.map_rows(0, self.rows)[1]
+
+        # A crash between the appends and meta.json leaves the counter behind; never reuse an id
+        max_id = max(max_logged_id, int(ids[-1]) if len(ids) else -1)
+        meta["next_chunk_id"] = max(meta.get("next_chunk_id", 0), max_id + 1)
+        deleted = np.sort(ids[~np.isin(ids, np.fromiter(documents, dtype="int64", count=len(documents)))])
+
+        self.index_rows = self._check_index(index, ids, deleted, index_rows)
+        if not self.index_rows:
+            index = None  # stale or missing; the background merge builds a fresh one
+
+        loaded = []
+        if self.index_rows:
+            loaded.append(self._segment(0, self.index_rows, documents, index))
+        if self.rows > self.index_rows:
+            loaded.append(self._segment(self.index_rows, self.rows, documents))
+        return loaded, deleted, meta
+
+    def _check_index(self, index, ids: np.ndarray, deleted: np.ndarray, index_rows) -> int:
+        """Rows the saved index covers, or 0 if it does not hold exactly the chunk ids it should."""
+        if index is None or not self.rows:
+            return 0
+        if index_rows is None:
+            # Older stores kept the index in sync with every live chunk
+            index_rows, expected = self.rows, ids[~np.isin(ids, deleted)]
+        elif 0 < index_rows <= self.rows:
+            expected = ids[:index_rows]
+        else:
+            return 0
+        indexed = np.sort(faiss.vector_to_array(index.id_map))
+        return index_rows if np.array_equal(indexed, expected) else 0
+
+    def _segment(self, first: int, end: int, documents: dict, index=None):
+        vectors, ids = self.map_rows(first, end)
+        chunks = ChunkStore.from_records([documents.get(chunk_id, REMOVED_RECORD) for chunk_id in ids.tolist()])
+        return make_segment(ids, vectors, chunks, index, (first, end))
+
+    def _read_meta(self):
+        """Contents of meta.json (its dim goes to self.dim), or None if there is none yet."""
+        try:
+            with open(self._file(META_FILE)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        stat = os.stat(self._file(META_FILE))
+        self._meta_stamp = (stat.st_ino, stat.st_mtime_ns)
+        self.dim = meta.pop("dim")
+        return meta
+
+    def _replay_log(self, repair: bool) -> tuple:
+        """
+        Replay chunks.jsonl from log_bytes on, advancing log_bytes: ({chunk_id: record} of
+        chunks added and not removed again, ids of earlier chunks removed, largest id added).
+        A partially written last line is cut off with repair (exclusive lock), else left for later.
+        """
+        documents, removed, max_id = {}, set(), -1
+        if not os.path.exists(self._file(CHUNKS_FILE)):
+            return documents, removed, max_id
+        with open(self._file(CHUNKS_FILE), "rb") as f:
+            f.seek(self.log_bytes)
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("unterminated line")
+                    record = json.loads(line)
+                except ValueError:
+                    # Partially written last line: cut it off so the next append starts on a fresh line
+                    if repair:
+                        print(f"[VectorStore] Truncating {CHUNKS_FILE} after an interrupted write")
+                        os.truncate(self._file(CHUNKS_FILE), self.log_bytes)
+                    break
+                self.log_bytes += len(line)
+                if record["op"] == "add":
+                    documents[record["id"]] = {key: record[key] for key in RECORD_KEYS if key in record}
+                    max_id = max(max_id, record["id"])
+                else:
+                    for chunk_id in record["ids"]:
+                        if documents.pop(chunk_id, None) is None:
+                            removed.add(chunk_id)
+        return documents, removed, max_id
+
+    def _complete_rows(self) -> int:
+        sizes = [os.path.getsize(self._file(name)) if os.path.exists(self._file(name)) else 0
+                 for name in (VECTORS_FILE, IDS_FILE)]
+        return min(sizes[0] // (4 * self.dim), sizes[1] // 8)
+
+    def _repair_vectors(self) -> int:
+        """Truncate vectors.f32 and vector_ids.i64 to their common row count; returns it."""
+        rows = self._complete_rows()
+        for name, target in ((VECTORS_FILE, rows * 4 * self.dim), (IDS_FILE, rows * 8)):
+            size = os.path.getsize(self._file(name)) if os.path.exists(self._file(name)) else 0
+            if size != target:
+                print(f"[VectorStore] Truncating {name} from {size} to {target} bytes after an interrupted write")
+                os.truncate(self._file(name), target)
+        return rows
+
+    def map_rows(self, first: int, end: int, vectors_path: str = None, ids_path: str = None) -> tuple:
+        """
+        Read-only memory maps of rows [first, end) of the vector and id files.
+        They are mapped through files opened under the lock, so a compaction by another
+        process swapping in new files does not change what this one's rows point to.
+        """
+        if end <= first:
+            return np.empty((0, self.dim), dtype="float32"), np.empty(0, dtype="int64")
+        with self._thread_lock:  # a reload in another thread may be swapping the files
+            vectors = np.memmap(vectors_path or self._mapped_file(VECTORS_FILE), dtype="float32", mode="r",
+                                offset=first * 4 * self.dim, shape=(end - first, self.dim))
+            ids = np.memmap(ids_path or self._mapped_file(IDS_FILE), dtype="int64", mode="r", offset=first * 8,
+                            shape=(end - first,))
+        return vectors, ids
+
+    def _mapped_file(self, name: str):
+        if name not in self._mapped:
+            self._mapped[name] = open(self._file(name), "rb")
+        return self._mapped[name]
+
+    def _close_mapped(self):
+        """Forget the files of the previous generation (existing memory maps stay valid)."""
+        for f in self._mapped.values():
+            f.close()
+        self._mapped = {}
+
+    # -----------------------------
+    # Other processes' writes
+    # -----------------------------
+    def changed(self) -> bool:
+        """Whether meta.json was rewritten since this process last read or wrote it (one stat, no lock)."""
+        try:
+            stat = os.stat(self._file(META_FILE))
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_mtime_ns) != self._meta_stamp
+
+    def read_changes(self, repair: bool = False):
+        """
+        What other processes wrote since this one last loaded, wrote or read changes
+        (call with the lock held, exclusive for repair), as StoreChanges; None if nothing.
+        Advances this process's position past it.
+        """
+        generation = self.generation
+        meta = self._read_meta()
+        if meta is None:
+            return None
+        if meta.pop("generation", 0) != generation:
+            return StoreChanges(reload=True)
+        meta.pop("index_rows", None)
+
+        rows = self._repair_vectors() if repair else self._complete_rows()
+        documents, removed, _ = self._replay_log(repair)
+        if rows == self.rows and not documents and not removed:
+            return None
+        first, self.rows = self.rows, rows
+        return StoreChanges(False, (first, rows), documents, np.array(sorted(removed), dtype="int64"), meta)
+
+    # -----------------------------
+    # Incremental writes
+    # -----------------------------
+    def append(self, new_ids: np.ndarray, doc_records: list[dict], vectors: np.ndarray, meta: dict) -> tuple:
+        """
+        Persist newly added chunks; returns the (first, end) rows they were written to.
+        Call with the lock held, after read_changes(repair=True).
+        """
+        self.dim = vectors.shape[1]
+        with self.locked():
+            if self._complete_rows() != self.rows:
+                raise RuntimeError("Vector store changed since it was last read; call read_changes() first")
+            with open(self._file(VECTORS_FILE), "ab") as f:
+                f.write(np.ascontiguousarray(vectors, dtype="float32").tobytes())
+            with open(self._file(IDS_FILE), "ab") as f:
+                f.write(np.ascontiguousarray(new_ids, dtype="int64").tobytes())
+            self._append_log([{"op": "add", "id": chunk_id, **doc}
+                              for chunk_id, doc in zip(new_ids.tolist(), doc_records)])
+            self._write_meta(meta)
+        first, self.rows = self.rows, self.rows + len(new_ids)
+        return first, self.rows
+
+    def remove(self, removed_ids: np.ndarray, meta: dict):
+        """Persist a removal as a tombstone; the rows stay in the files until the next compaction."""
+        with self.locked():
+            self._append_log([{"op": "remove", "ids": removed_ids.tolist()}])
+            self._write_meta(meta)
+
+    def _append_log(self, records: list[dict]):
+        data = "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+        with open(self._file(CHUNKS_FILE), "ab") as f:
+            f.write(data)
+        self.log_bytes += len(data)
+
+    def _write_meta(self, meta: dict):
+        def write_meta(p):
+            with open(p, "w") as f:
+                json.dump({"dim": self.dim, "index_rows": self.index_rows, "generation": self.generation, **meta}, f)
+
+        self._replace(META_FILE, write_meta)
+        stat = os.stat(self._file(META_FILE))
+        self._meta_stamp = (stat.st_ino, stat.st_mtime_ns)
+
+    # -----------------------------
+    # Compaction
+    # -----------------------------
+    def write_compacted(self, blocks) -> tuple:
+        """
+        Write the live rows given as blocks of (ids, vectors, records) to temporary
+        vector, id and log files (no lock: only this process writes them).
+        Returns (rows written, memory maps of the written vectors and ids).
+        """
+        rows = 0
+        with open(self._compacted(VECTORS_FILE), "wb") as vectors_file, \
+                open(self._compacted(IDS_FILE), "wb") as ids_file, \
+                open(self._compacted(CHUNKS_FILE), "w", encoding="utf-8") as log_file:
+            for ids, vectors, records in blocks:
+                vectors_file.write(np.ascontiguousarray(vectors, dtype="float32").tobytes())
+                ids_file.write(np.ascontiguousarray(ids, dtype="int64").tobytes())
+                for chunk_id, record in zip(ids.tolist(), records):
+                    log_file.write(json.dumps({"op": "add", "id": chunk_id, **record}) + "\n")
+                rows += len(ids)
+        return rows, self.map_rows(0, rows, self._compacted(VECTORS_FILE), self._compacted(IDS_FILE))
+
+    def finish_compaction(self, rows: int, position: tuple, index, meta: dict) -> int:
+        """
+        Swap in the files from write_compacted. Rows and log records written after
+        position (taken when the compacted snapshot was current) are carried over
+        behind the compacted rows, then the index over those rows (None for exact
+        search) and meta are written. Returns how far the carried-over rows moved
+        down (new row = old row - shift).
+        """
+        old_rows, old_log_bytes = position
+        row_bytes = 4 * self.dim
+        with self.locked():
+            for name, start in ((VECTORS_FILE, old_rows * row_bytes), (IDS_FILE, old_rows * 8),
+                                (CHUNKS_FILE, old_log_bytes)):
+                with open(self._file(name), "rb") as src, open(self._compacted(name), "ab") as dst:
+                    src.seek(start)
+                    dst.write(src.read())
+                os.replace(self._compacted(name), self._file(name))
+            self._close_mapped()
+            self.log_bytes = os.path.getsize(self._file(CHUNKS_FILE))
+
+            if index is not None:
+                self._replace(INDEX_FILE, lambda p: faiss.write_index(index, p))
+            elif os.path.exists(self._file(INDEX_FILE)):
+                os.remove(self._file(INDEX_FILE))
+            self.index_rows = rows if index is not None else 0
+            self.generation += 1
+            self._write_meta(meta)
+
+        shift = old_rows - rows
+        self.rows -= shift
+        return shift
+
+    def discard_compaction(self):
+        for name in (VECTORS_FILE, IDS_FILE, CHUNKS_FILE):
+            if os.path.exists(self._compacted(name)):
+                os.remove(self._compacted(name))
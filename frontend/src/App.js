@@ -1,5 +1,5 @@
 import React, { useState } from "react";
-import { askQuery, uploadFiles, removeFiles } from "./api/ragApi";
+import { askQuery, uploadFiles, removeFiles, getJob } from "./api/ragApi";
 import ChatBox from "./components/ChatBox";
 import MetricsCard from "./components/MetricsCard";
 
@@ -103,11 +103,26 @@ function App() {
 
     try {
       const res = await uploadFiles(files);
-      setUploadMessage(`✅ Uploaded ${res.data.count} documents successfully!`);
-      setUploadedFiles((prev) => [
-        ...prev,
-        ...Array.from(files).map((f) => f.name),
-      ]);
+      if (!res.data.job_id) {
+        setUploadMessage(res.data.error || res.data.status);
+        return;
+      }
+
+      // Ingestion runs in the background; poll the job until it finishes
+      let job = null;
+      while (!job || job.status === "queued" || job.status === "running") {
+        await new Promise((r) => setTimeout(r, 1000));
+        job = (await getJob(res.data.job_id)).data;
+        setUploadMessage(`⏳ Processing... ${job.percent}% (${job.chunks_embedded} chunks embedded)`);
+      }
+
+      const added = job.added || [];
+      setUploadMessage(
+        added.length
+          ? `✅ Uploaded ${job.added.length} documents successfully!`
+          : "❌ No valid text extracted from uploaded files."
+      );
+      setUploadedFiles((prev) => [...prev, ...added]);
     } catch (err) {
       console.error("Upload error:", err);
       setUploadMessage("❌ Error uploading files.");
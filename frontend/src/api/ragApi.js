@@ -18,6 +18,10 @@ export const uploadFiles = async (files) => {
   });
 };
 
+export const getJob = async (jobId) => {
+  return axios.get(`${BASE_URL}/jobs/${jobId}`);
+};
+
 // renamed askQuestion to askQuery
 export const askQuery = async (question) => {
   return axios.post(`${BASE_URL}/query`, { question });